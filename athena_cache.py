@@ -0,0 +1,290 @@
+import hashlib
+import json
+import re
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import athena_query
+import state_store
+
+glue_client = boto3.client('glue')
+
+# Re-running a query whose source data has not changed returns the result Athena already wrote instead of scanning the
+# tables again. Results are keyed by the normalized SQL plus a version token per source table, built from the keys,
+# sizes and ETags of the objects under the table's location, so any change to the data makes a new key. The cache
+# index is one small JSON document in a state_store location, so it can live in s3 and be shared.
+CACHE_INDEX = 'athena-cache-index.json'
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_MAX_ENTRIES = 1000
+# Past CACHE_MAX_ENTRIES the least recently used entries go. A hit is written back to the index so other processes
+# see it too, but at most once per LAST_USED_RESOLUTION_SECONDS for an entry, so a hot query doesn't rewrite the index
+# on every run.
+LAST_USED_RESOLUTION_SECONDS = 60
+
+TOKEN_PATTERN = re.compile(r"('(?:[^']|'')*')|(\"[^\"]*\")|(--[^\n]*)|(/\*.*?\*/)|(\s+)|([^'\"\s/-]+|.)", re.DOTALL)
+# A FROM or JOIN is followed by a comma separated list of tables, each with an optional alias. Anything the list goes
+# on with that isn't a plain table (a function like unnest(...), a subquery after a comma) can hide a table from us, so
+# table_references gives up on the query and it isn't cached.
+NAME = r'(?:"[^"]+"|\w+)'
+ALIAS_KEYWORDS = ('where', 'group', 'order', 'having', 'limit', 'offset', 'fetch', 'join', 'inner', 'left', 'right',
+                  'full', 'cross', 'natural', 'on', 'using', 'union', 'intersect', 'except', 'window', 'tablesample',
+                  'for', 'lateral')
+ITEM = r'(%s(?:\s*\.\s*%s)?)((?:\s+(?:as\s+)?(?!(?:%s)\b)%s)?)' % (NAME, NAME, '|'.join(ALIAS_KEYWORDS), NAME)
+ITEM_PATTERN = re.compile(ITEM)
+# "is distinct from" compares two values and reads no table.
+FROM_LIST_PATTERN = re.compile(r'(?<!distinct )\b(?:from|join)\s+(%s(?:\s*,\s*%s)*)' % (ITEM, ITEM))
+SUBQUERY_PATTERN = re.compile(r'(?<!distinct )\b(?:from|join)\s*\(')
+# A FROM only names tables where it belongs to a SELECT at the same level of parentheses; the FROM in
+# extract(year from d) or substring(s from 2) is part of a function call.
+SELECT_PATTERN = re.compile(r'\bselect\b')
+GROUP_PATTERN = re.compile(r'\([^()]*\)')
+SUBQUERY_LIST_PATTERN = re.compile(r'\s*(?:(?:as\s+)?(?!(?:%s)\b)%s(?:\s*\([^)]*\))?)?\s*,'
+                                   % ('|'.join(ALIAS_KEYWORDS), NAME))
+CTE_PATTERN = re.compile(r'(?:\bwith|,)\s*("[^"]+"|\w+)\s+as\s*\(')
+
+
+def normalize_sql(sql):
+  # Comments go, runs of whitespace become one space and everything but string literals is lowercased, which is
+  # how Athena treats keywords and identifiers anyway.
+  parts = []
+  for literal, identifier, line_comment, block_comment, space, other in TOKEN_PATTERN.findall(sql):
+    if literal:
+      parts.append(literal)
+    elif identifier or other:
+      parts.append((identifier or other).lower())
+    elif parts and parts[-1] != ' ':
+      parts.append(' ')
+  return ''.join(parts).strip().rstrip(';').strip()
+
+
+def table_references(normalized_sql):
+  # Returns every table name after a FROM or JOIN, split into its parts, or None when some FROM list has more in it
+  # than plain tables.
+  masked = mask_literals(normalized_sql)
+  for match in SUBQUERY_PATTERN.finditer(masked):
+    if not selects_from(masked, match.start()):
+      continue
+    end = closing_paren(masked, match.end() - 1)
+    if end is None or SUBQUERY_LIST_PATTERN.match(masked, end + 1):
+      return None
+  references = []
+  for match in from_lists(masked):
+    if masked[match.end():].lstrip()[:1] in (',', '('):
+      return None
+    for item in ITEM_PATTERN.finditer(masked, match.start(1), match.end(1)):
+      references.append([name.strip().strip('"') for name in item.group(1).split('.')])
+  return references
+
+
+def mask_literals(normalized_sql):
+  # The same query with the inside of every string literal blanked out, so that patterns matched against it don't
+  # find keywords or table names in the literals, and its offsets still line up with normalized_sql.
+  return TOKEN_PATTERN.sub(lambda token: "'%s'" % ('?' * (len(token.group(1)) - 2)) if token.group(1)
+                           else token.group(0), normalized_sql)
+
+
+def from_lists(masked):
+  return [match for match in FROM_LIST_PATTERN.finditer(masked) if selects_from(masked, match.start())]
+
+
+def selects_from(masked, position):
+  # Whether the FROM or JOIN at position belongs to a SELECT: one has to come before it inside the innermost
+  # parentheses around it (or at the top level), not counting any nested parentheses in between.
+  depth = 0
+  start = 0
+  for index in range(position - 1, -1, -1):
+    if masked[index] == ')':
+      depth += 1
+    elif masked[index] == '(':
+      if depth == 0:
+        start = index + 1
+        break
+      depth -= 1
+  level = masked[start:position]
+  while True:
+    flattened = GROUP_PATTERN.sub('', level)
+    if flattened == level:
+      return SELECT_PATTERN.search(level) is not None
+    level = flattened
+
+
+def closing_paren(normalized_sql, start):
+  # Index of the parenthesis closing the one at start, skipping over quoted literals and identifiers.
+  depth = 0
+  quote = None
+  for index in range(start, len(normalized_sql)):
+    char = normalized_sql[index]
+    if quote:
+      if char == quote:
+        quote = None
+    elif char in '\'"':
+      quote = char
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      depth -= 1
+      if depth == 0:
+        return index
+  return None
+
+
+def replace_tables(normalized_sql, replace):
+  # replace gets the name parts of each table in a FROM list and returns the text to put there instead, or None to
+  # leave it. A table without an alias keeps its own name as one, so columns qualified with it still resolve.
+  masked = mask_literals(normalized_sql)
+  parts = []
+  last = 0
+  for match in from_lists(masked):
+    for item in ITEM_PATTERN.finditer(masked, match.start(1), match.end(1)):
+      replacement = replace([name.strip().strip('"') for name in item.group(1).split('.')])
+      if replacement is None:
+        continue
+      alias = item.group(2) or ' ' + item.group(1).split('.')[-1].strip()
+      parts.extend([normalized_sql[last:item.start()], replacement, alias])
+      last = item.end()
+  parts.append(normalized_sql[last:])
+  return ''.join(parts)
+
+
+def referenced_tables(normalized_sql, database):
+  # Returns None when table_references can't be sure it found every table.
+  references = table_references(normalized_sql)
+  if references is None:
+    return None
+  ctes = set(name.strip('"') for name in CTE_PATTERN.findall(mask_literals(normalized_sql)))
+  tables = set()
+  for names in references:
+    if len(names) == 1 and names[0] in ctes:
+      continue
+    tables.add((database, names[0]) if len(names) == 1 else (names[0], names[1]))
+  return sorted(tables)
+
+
+def table_location(database, table):
+  return glue_client.get_table(DatabaseName=database, Name=table)['Table']['StorageDescriptor']['Location']
+
+
+def location_version(location):
+  bucket, _, prefix = location[len('s3://'):].partition('/')
+  digest = hashlib.sha256()
+  total_bytes = 0
+  paginator = athena_query.s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      digest.update(('%s\0%d\0%s\n' % (obj['Key'], obj['Size'], obj['ETag'])).encode('utf-8'))
+      total_bytes += obj['Size']
+  return digest.hexdigest(), total_bytes
+
+
+def table_version(database, table):
+  return location_version(table_location(database, table))
+
+
+class AthenaResultCache(object):
+
+  def __init__(self, store, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+    self.store = store
+    self.ttl_seconds = ttl_seconds
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.expirations = 0
+    self.evictions = 0
+    self.uncacheable = 0
+    self._index = None
+
+  def run(self, sql, database, output_location):
+    key = self.cache_key(sql, database)
+    if key is None:
+      self.uncacheable += 1
+      return athena_query.wait_for_query(athena_query.start_query(sql, database, output_location))
+    query_execution = self.lookup(key)
+    if query_execution is not None:
+      return query_execution
+    query_execution = athena_query.wait_for_query(athena_query.start_query(sql, database, output_location))
+    self.add(key, query_execution)
+    return query_execution
+
+  def cache_key(self, sql, database):
+    normalized = normalize_sql(sql)
+    tables = referenced_tables(normalized, database)
+    if tables is None:
+      return None
+    versions = []
+    for table_database, table in tables:
+      try:
+        versions.append('%s.%s=%s' % (table_database, table, table_version(table_database, table)[0]))
+      except ClientError as e:
+        # Views, unnest aliases and the like have no location of their own, so there is nothing to version them by.
+        if e.response['Error']['Code'] != 'EntityNotFoundException':
+          raise
+        return None
+    document = json.dumps({'sql': normalized, 'database': database, 'tables': versions}, sort_keys=True)
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+  def lookup(self, key):
+    index = self._load()
+    entry = index.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    if time.time() - entry['Created'] > self.ttl_seconds or not self._result_exists(entry['OutputLocation']):
+      self.expirations += 1
+      self.misses += 1
+      del index[key]
+      self._save()
+      return None
+    self.hits += 1
+    now = time.time()
+    if now - entry.get('LastUsed', entry['Created']) >= LAST_USED_RESOLUTION_SECONDS:
+      entry['LastUsed'] = now
+      self._save()
+    return {'QueryExecutionId': entry['QueryExecutionId'], 'Status': {'State': 'SUCCEEDED'},
+            'ResultConfiguration': {'OutputLocation': entry['OutputLocation']}}
+
+  def add(self, key, query_execution):
+    index = self._load()
+    now = time.time()
+    index[key] = {'QueryExecutionId': query_execution['QueryExecutionId'], 'Created': now, 'LastUsed': now,
+                  'OutputLocation': query_execution['ResultConfiguration']['OutputLocation']}
+    for stale in [k for k, entry in index.items() if now - entry['Created'] > self.ttl_seconds]:
+      del index[stale]
+      self.expirations += 1
+    if len(index) > self.max_entries:
+      for victim in sorted(index, key=lambda k: index[k]['LastUsed'])[:len(index) - self.max_entries]:
+        del index[victim]
+        self.evictions += 1
+    self._save()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'expirations': self.expirations, 'evictions': self.evictions,
+            'uncacheable': self.uncacheable, 'entries': len(self._load())}
+
+  def _result_exists(self, output_location):
+    bucket, key = athena_query.result_object({'ResultConfiguration': {'OutputLocation': output_location}})
+    try:
+      athena_query.s3_client.head_object(Bucket=bucket, Key=key)
+      return True
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+        return False
+      raise
+
+  def _load(self):
+    if self._index is None:
+      stored = self.store.get(CACHE_INDEX)
+      self._index = json.loads(stored) if stored else {}
+    return self._index
+
+  def _save(self):
+    self.store.put(CACHE_INDEX, json.dumps(self._index, sort_keys=True).encode('utf-8'))
+
+
+if __name__ == '__main__':
+  cache = AthenaResultCache(state_store.open_store(athena_query.query_bucket_url + 'cache/', athena_query.s3_client))
+  for frame in athena_query.iter_result_frames(cache.run(athena_query.sql_query_string, 'census',
+                                                         athena_query.query_bucket_url)):
+    print(frame)
+  print(cache.stats())
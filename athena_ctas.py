@@ -0,0 +1,161 @@
+import argparse
+import json
+import re
+
+from botocore.exceptions import ClientError
+
+import athena_cache
+import athena_query
+
+# A CSV table costs a full scan on every query. materialize() copies it, with CREATE TABLE AS SELECT, into a
+# partitioned, snappy compressed Parquet table next to it, so queries only read the columns they project and the
+# partitions their predicates select. The version token of the source data (see athena_cache.location_version) is
+# stored in the copy's table parameters, and rewrite_query() only points a query at the copy while that token still
+# matches the source; once the source changes the query goes back to the CSV table until it is materialized again.
+COLUMNAR_SUFFIX = '_parquet'
+SOURCE_VERSION_PARAMETER = 'source_version'
+SOURCE_TABLE_PARAMETER = 'source_table'
+
+
+def columnar_name(table):
+  return table + COLUMNAR_SUFFIX
+
+
+def columnar_location(database, table, version, base_location):
+  # CTAS refuses to write into a non empty location, so every materialization of a new source version gets its own.
+  return '%s%s/%s/%s/' % (base_location, database, columnar_name(table), version[:16])
+
+
+def get_table(database, table):
+  try:
+    return athena_cache.glue_client.get_table(DatabaseName=database, Name=table)['Table']
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'EntityNotFoundException':
+      raise
+    return None
+
+
+def is_fresh(database, table, version):
+  columnar = get_table(database, columnar_name(table))
+  return columnar is not None and columnar.get('Parameters', {}).get(SOURCE_VERSION_PARAMETER) == version
+
+
+def materialize(database, table, partition_by, output_location, base_location, force=False):
+  source = get_table(database, table)
+  version, source_bytes = athena_cache.location_version(source['StorageDescriptor']['Location'])
+  if not force and is_fresh(database, table, version):
+    return {'Table': '%s.%s' % (database, columnar_name(table)), 'SourceVersion': version, 'SourceBytes': source_bytes,
+            'Created': False}
+
+  columns = [column['Name'] for column in source['StorageDescriptor']['Columns'] + source.get('PartitionKeys', [])]
+  # Partition columns have to come last in the select list, in the order they are named in partitioned_by.
+  ordered = [column for column in columns if column not in partition_by] + list(partition_by)
+  properties = ["format = 'PARQUET'", "parquet_compression = 'SNAPPY'",
+                "external_location = '%s'" % columnar_location(database, table, version, base_location)]
+  if partition_by:
+    properties.append('partitioned_by = ARRAY[%s]' % ', '.join("'%s'" % column for column in partition_by))
+
+  run(['DROP TABLE IF EXISTS `%s`.`%s`' % (database, columnar_name(table)),
+       'CREATE TABLE "%s"."%s" WITH (%s) AS SELECT %s FROM "%s"."%s"' % (
+         database, columnar_name(table), ', '.join(properties), ', '.join('"%s"' % column for column in ordered),
+         database, table)],
+      database, output_location)
+
+  columnar = get_table(database, columnar_name(table))
+  # get_table returns more than update_table takes back, and more with every new Glue feature, so only the fields
+  # TableInput has are passed on.
+  accepted = athena_cache.glue_client.meta.service_model.shape_for('TableInput').members
+  table_input = dict((field, value) for field, value in columnar.items() if field in accepted)
+  table_input['Parameters'] = dict(columnar.get('Parameters', {}), **{
+    SOURCE_VERSION_PARAMETER: version,
+    SOURCE_TABLE_PARAMETER: '%s.%s' % (database, table),
+  })
+  athena_cache.glue_client.update_table(DatabaseName=database, TableInput=table_input)
+  return {'Table': '%s.%s' % (database, columnar_name(table)), 'SourceVersion': version, 'SourceBytes': source_bytes,
+          'Created': True}
+
+
+def run(statements, database, output_location):
+  # The DROP has to finish before the CTAS starts, so these run one after the other.
+  for sql in statements:
+    athena_query.wait_for_query(athena_query.start_query(sql, database, output_location))
+
+
+def rewrite_query(sql, database):
+  """Point every table in sql that has a fresh columnar copy at that copy.
+
+  Returns the rewritten (normalized) query and, for each source table that was read, its version token, its size in
+  bytes and whether the copy was used.
+  """
+  normalized = athena_cache.normalize_sql(sql)
+  tables = {}
+  # A query athena_cache can't find every table of is run as it is, since its scan report would be incomplete.
+  for table_database, table in athena_cache.referenced_tables(normalized, database) or []:
+    source = None if table.endswith(COLUMNAR_SUFFIX) else get_table(table_database, table)
+    if source is None or source.get('TableType') == 'VIRTUAL_VIEW':
+      continue
+    version, source_bytes = athena_cache.location_version(source['StorageDescriptor']['Location'])
+    tables[table_database, table] = {'SourceVersion': version, 'SourceBytes': source_bytes,
+                                     'Columnar': is_fresh(table_database, table, version)}
+
+  def replace(names):
+    table_database, table = (database, names[0]) if len(names) == 1 else names
+    if not tables.get((table_database, table), {}).get('Columnar'):
+      return None
+    return '"%s"."%s"' % (table_database, columnar_name(table))
+
+  return athena_cache.replace_tables(normalized, replace), tables
+
+
+def run_query(sql, database, output_location):
+  rewritten, tables = rewrite_query(sql, database)
+  query_execution = athena_query.wait_for_query(athena_query.start_query(rewritten, database, output_location))
+  return query_execution, scan_report(query_execution, rewritten, tables)
+
+
+def scan_report(query_execution, rewritten, tables):
+  # Against a CSV table Athena scans every byte under the table's location, so the source size is what the query
+  # would have scanned without the columnar copies.
+  scanned = query_execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+  source_bytes = sum(table['SourceBytes'] for table in tables.values())
+  return {
+    'QueryExecutionId': query_execution['QueryExecutionId'],
+    'Query': rewritten,
+    'Tables': dict(('%s.%s' % key, table) for key, table in tables.items()),
+    'DataScannedInBytes': scanned,
+    'SourceBytes': source_bytes,
+    'SavedBytes': max(source_bytes - scanned, 0),
+    'SavedPercent': round(100.0 * max(source_bytes - scanned, 0) / source_bytes, 1) if source_bytes else 0.0,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Materialize Athena tables as partitioned Parquet and query them.')
+  parser.add_argument('--database', default='census', help='(default: %(default)s)')
+  parser.add_argument('--output-location', default=athena_query.query_bucket_url,
+                      help='where Athena writes query results (default: %(default)s)')
+  commands = parser.add_subparsers(dest='command', required=True)
+  materialize_command = commands.add_parser('materialize', help='create or refresh the columnar copy of a table')
+  materialize_command.add_argument('table')
+  materialize_command.add_argument('--partition-by', nargs='*', default=[], metavar='COLUMN')
+  materialize_command.add_argument('--location', default=athena_query.query_bucket_url + 'columnar/',
+                                   help='s3 prefix the Parquet copies are written under (default: %(default)s)')
+  materialize_command.add_argument('--force', action='store_true', help='materialize even if the copy is fresh')
+  query_command = commands.add_parser('query', help='run a query against the columnar copies and report the savings')
+  query_command.add_argument('sql', nargs='?', default=athena_query.sql_query_string)
+  args = parser.parse_args()
+
+  if args.command == 'materialize':
+    if not re.match(r'^\w+$', args.table):
+      parser.error('table has to be a bare table name in --database')
+    print(json.dumps(materialize(args.database, args.table, args.partition_by, args.output_location, args.location,
+                                 args.force), indent=2))
+  else:
+    query_execution, report = run_query(args.sql, args.database, args.output_location)
+    for frame in athena_query.iter_result_frames(query_execution):
+      print(frame)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+  main()
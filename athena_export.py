@@ -0,0 +1,205 @@
+import argparse
+import codecs
+import concurrent.futures
+import csv
+import gzip
+import hashlib
+import io
+import json
+import threading
+
+import athena_query
+
+# Runs an extraction query and streams its result straight into gzipped CSV shards in the input bucket, laid out as
+#
+#   <prefix>train/part-00000.csv.gz ... <prefix>train/part-<N-1>.csv.gz
+#   <prefix>test/part-00000.csv.gz ...
+#
+# so a manifest channel over <prefix>train/ can use ShardedByS3Key. Rows go to train or test, and to a shard, by a hash
+# of the key column, so the same row always lands in the same place no matter how often the export is rerun. Every
+# shard is its own multipart upload; parts are uploaded from a small pool as soon as they fill up and the number of
+# parts in flight is capped, so memory is bounded by the shard count and the part size rather than the result size.
+PART_BYTES = 8 * 1024 * 1024
+UPLOAD_WORKERS = 8
+SPLIT_BUCKETS = 10000
+
+
+def split_for(key, test_fraction, shards):
+  digest = hashlib.md5(key.encode('utf-8')).digest()
+  split = 'test' if int.from_bytes(digest[:4], 'big') % SPLIT_BUCKETS < test_fraction * SPLIT_BUCKETS else 'train'
+  return split, int.from_bytes(digest[4:8], 'big') % shards
+
+
+class ShardUpload(object):
+  """One gzipped CSV object written as a multipart upload.
+
+  Rows are compressed into an in-memory buffer that is handed to the uploader as a part whenever it reaches
+  part_bytes. Every part but the last has to be at least 5MB, which part_bytes guarantees.
+  """
+
+  def __init__(self, uploader, bucket, key, header=None, part_bytes=PART_BYTES):
+    self.uploader = uploader
+    self.bucket = bucket
+    self.key = key
+    self.part_bytes = part_bytes
+    self.rows = 0
+    self._upload_id = uploader.s3_client.create_multipart_upload(Bucket=bucket, Key=key,
+                                                                 ContentType='application/x-gzip')['UploadId']
+    self._parts = []
+    self._buffer = io.BytesIO()
+    self._gzip = gzip.GzipFile(fileobj=self._buffer, mode='wb', mtime=0)
+    self._text = codecs.getwriter('utf-8')(self._gzip)
+    self._csv = csv.writer(self._text, lineterminator='\n')
+    if header:
+      self._csv.writerow(header)
+
+  def write(self, row):
+    self._csv.writerow(row)
+    self.rows += 1
+    if self._buffer.tell() >= self.part_bytes:
+      self._flush_part()
+
+  def close(self):
+    self._gzip.close()
+    self._flush_part()
+    parts = [future.result() for future in self._parts]
+    response = self.uploader.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 UploadId=self._upload_id,
+                                                                 MultipartUpload={'Parts': parts})
+    self._upload_id = None
+    return response.get('VersionId')
+
+  def abort(self):
+    if self._upload_id is None:
+      return
+    for future in self._parts:
+      future.cancel()
+    self.uploader.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+  def _flush_part(self):
+    data = self._buffer.getvalue()
+    if not data and self._parts:
+      return
+    self._buffer.seek(0)
+    self._buffer.truncate()
+    self._parts.append(self.uploader.upload_part(self.bucket, self.key, self._upload_id, len(self._parts) + 1, data))
+
+
+class PartUploader(object):
+
+  def __init__(self, s3_client, max_workers=UPLOAD_WORKERS):
+    self.s3_client = s3_client
+    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    # Twice the worker count keeps the pool busy while the reader fills the next parts, without letting a slow upload
+    # pile parts up in memory.
+    self._slots = threading.BoundedSemaphore(2 * max_workers)
+
+  def upload_part(self, bucket, key, upload_id, part_number, data):
+    self._slots.acquire()
+    try:
+      return self._pool.submit(self._upload, bucket, key, upload_id, part_number, data)
+    except Exception:
+      self._slots.release()
+      raise
+
+  def shutdown(self):
+    self._pool.shutdown(wait=True)
+
+  def _upload(self, bucket, key, upload_id, part_number, data):
+    try:
+      response = self.s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                            Body=data)
+      return {'PartNumber': part_number, 'ETag': response['ETag']}
+    finally:
+      self._slots.release()
+
+
+def iter_result_rows(query_execution):
+  bucket, key = athena_query.result_object(query_execution)
+  body = athena_query.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+  try:
+    # csv reads the stream line by line, so quoted fields with embedded newlines still come out as one row.
+    for row in csv.reader(io.TextIOWrapper(body, encoding='utf-8', newline='')):
+      yield row
+  finally:
+    body.close()
+
+
+def export(sql, database, output_location, bucket, prefix, key_column, shards=4, test_fraction=0.2, header=True,
+           part_bytes=PART_BYTES, upload_workers=UPLOAD_WORKERS):
+  query_execution = athena_query.wait_for_query(athena_query.start_query(sql, database, output_location))
+  rows = iter_result_rows(query_execution)
+  columns = next(rows)
+  key_index = columns.index(key_column)
+
+  uploader = PartUploader(athena_query.s3_client, upload_workers)
+  uploads = {}
+  try:
+    for split in ('train', 'test'):
+      for shard in range(shards):
+        uploads[split, shard] = ShardUpload(uploader, bucket, '%s%s/part-%05d.csv.gz' % (prefix, split, shard),
+                                            columns if header else None, part_bytes)
+    for row in rows:
+      uploads[split_for(row[key_index], test_fraction, shards)].write(row)
+    versions = dict((upload.key, upload.close()) for upload in uploads.values())
+  except BaseException:
+    for upload in uploads.values():
+      upload.abort()
+    raise
+  finally:
+    uploader.shutdown()
+
+  base = 's3://%s/%s' % (bucket, prefix)
+  counts = {'train': 0, 'test': 0}
+  for (split, _), upload in uploads.items():
+    counts[split] += upload.rows
+  return {
+    'QueryExecutionId': query_execution['QueryExecutionId'],
+    'Prefix': base,
+    'Channels': {'train': base + 'train/', 'test': base + 'test/'},
+    'Rows': counts,
+    'Objects': [{'Key': key, 'VersionId': versions[key]} for key in sorted(versions)],
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Export an Athena query into sharded, gzipped train/test channels.')
+  parser.add_argument('destination', help='s3://bucket/prefix/ to write the train/ and test/ shards under')
+  parser.add_argument('--sql', default=athena_query.sql_query_string, help='extraction query')
+  parser.add_argument('--sql-file', help='read the extraction query from this file instead')
+  parser.add_argument('--database', default='census', help='(default: %(default)s)')
+  parser.add_argument('--output-location', default=athena_query.query_bucket_url,
+                      help='where Athena writes the query result (default: %(default)s)')
+  parser.add_argument('--key-column', required=True, help='column whose hash decides the split and the shard')
+  parser.add_argument('--shards', type=int, default=4, help='shards per split (default: %(default)s)')
+  parser.add_argument('--test-fraction', type=float, default=0.2, help='(default: %(default)s)')
+  parser.add_argument('--no-header', dest='header', action='store_false', help='leave the header row out of shards')
+  parser.add_argument('--part-mb', type=int, default=PART_BYTES // (1024 * 1024),
+                      help='multipart part size in MB, at least 5 (default: %(default)s)')
+  parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS, help='(default: %(default)s)')
+  parser.add_argument('--report', help='also write the JSON report to this file')
+  args = parser.parse_args()
+
+  if args.part_mb < 5:
+    parser.error('--part-mb has to be at least 5')
+  if not args.destination.startswith('s3://'):
+    parser.error('destination has to be an s3:// url')
+  bucket, _, prefix = args.destination[len('s3://'):].partition('/')
+  if prefix and not prefix.endswith('/'):
+    prefix += '/'
+  sql = args.sql
+  if args.sql_file:
+    with open(args.sql_file) as sql_file:
+      sql = sql_file.read()
+
+  report = export(sql, args.database, args.output_location, bucket, prefix, args.key_column, args.shards,
+                  args.test_fraction, args.header, args.part_mb * 1024 * 1024, args.upload_workers)
+  output = json.dumps(report, indent=2)
+  if args.report:
+    with open(args.report, 'w') as report_file:
+      report_file.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
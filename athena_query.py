@@ -1,3 +1,4 @@
+import asyncio
 import boto3
 import time
 import pandas as pd
@@ -8,24 +9,181 @@ s3_client = boto3.client('s3')
 sql_query_string = 'SELECT * FROM "census"."adult_data_manual" limit 11'
 query_bucket = 'aws-athena-query-results-007038732177-us-west-2'
 query_bucket_url = 's3://' + query_bucket + '/'
-response = client.start_query_execution(
-        QueryString=sql_query_string,
-        QueryExecutionContext={
-            'Database': 'census'
-        },
-        ResultConfiguration={
-            'OutputLocation': query_bucket_url 
-        }
-    )
-query_id = response['QueryExecutionId']
-
-#response = client.get_query_results(QueryExecutionId=query_id)
-while True:
-  response = client.get_query_execution(QueryExecutionId=query_id)  
-  if response['QueryExecution']['Status']['State'] in 'SUCCEEDED':
-    key = response['QueryExecution']['ResultConfiguration']['OutputLocation'].split("/")[-1] 
-    obj = s3_client.get_object(Bucket=query_bucket, Key=key)
-    print obj['Body'].read()
-    break
-  else:
-    time.sleep(2)
+
+# Results are read straight off the s3 response stream, CHUNK_ROWS rows per DataFrame, so memory stays bounded by the
+# chunk size however large the result is.
+CHUNK_ROWS = 100000
+
+# How Athena's result metadata types map onto pandas. Integer and boolean columns use pandas' nullable dtypes because
+# Athena writes NULLs as empty fields. Anything not listed here (varchar, arrays, maps, json...) is read as a string.
+ATHENA_DTYPES = {
+  'boolean': 'boolean',
+  'tinyint': 'Int8',
+  'smallint': 'Int16',
+  'integer': 'Int32',
+  'bigint': 'Int64',
+  'float': 'float32',
+  'real': 'float32',
+  'double': 'float64',
+  'decimal': 'float64',
+}
+ATHENA_DATE_TYPES = ('date', 'timestamp')
+
+# Queries are polled with exponential backoff, starting at POLL_INITIAL_SECONDS and capped at POLL_MAX_SECONDS, so
+# short queries come back quickly and long ones don't burn API calls. batch_get_query_execution takes up to 50 ids.
+POLL_INITIAL_SECONDS = 0.5
+POLL_MAX_SECONDS = 10
+BATCH_GET_LIMIT = 50
+FAILED_STATES = ('FAILED', 'CANCELLED')
+
+
+class AthenaQueryError(Exception):
+
+  def __init__(self, query_execution):
+    status = query_execution['Status']
+    super(AthenaQueryError, self).__init__('query %s %s: %s' % (query_execution['QueryExecutionId'], status['State'],
+                                                                status.get('StateChangeReason', 'no reason given')))
+    self.query_execution = query_execution
+
+
+def start_query(sql, database, output_location):
+  response = client.start_query_execution(
+    QueryString=sql,
+    QueryExecutionContext={
+      'Database': database
+    },
+    ResultConfiguration={
+      'OutputLocation': output_location
+    }
+  )
+  return response['QueryExecutionId']
+
+
+def wait_for_query(query_id):
+  delay = POLL_INITIAL_SECONDS
+  while True:
+    query_execution = client.get_query_execution(QueryExecutionId=query_id)['QueryExecution']
+    state = query_execution['Status']['State']
+    if state == 'SUCCEEDED':
+      return query_execution
+    if state in FAILED_STATES:
+      raise AthenaQueryError(query_execution)
+    time.sleep(delay)
+    delay = min(delay * 2, POLL_MAX_SECONDS)
+
+
+class AthenaExecutor(object):
+  """Runs many Athena queries at once from asyncio.
+
+  At most max_concurrency queries are running at any time. Their status is checked by a single poller that batches
+  every query due for a check into batch_get_query_execution calls, backing each query off exponentially until it
+  reaches a terminal state. run() resolves with the QueryExecution of a query that succeeded and raises
+  AthenaQueryError for one that failed or was cancelled.
+  """
+
+  def __init__(self, max_concurrency=5, initial_delay=POLL_INITIAL_SECONDS, max_delay=POLL_MAX_SECONDS):
+    self.max_concurrency = max_concurrency
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self._semaphore = None
+    self._pending = {}
+    self._poller = None
+    self._wakeup = None
+
+  async def run(self, sql, database, output_location):
+    loop = asyncio.get_running_loop()
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self.max_concurrency)
+      self._wakeup = asyncio.Event()
+    async with self._semaphore:
+      query_id = await loop.run_in_executor(None, start_query, sql, database, output_location)
+      future = loop.create_future()
+      self._pending[query_id] = [future, self.initial_delay, loop.time() + self.initial_delay]
+      self._wakeup.set()
+      if self._poller is None or self._poller.done():
+        self._poller = loop.create_task(self._poll())
+      return await future
+
+  async def run_all(self, queries):
+    # queries are (sql, database, output_location) tuples; failures come back as AthenaQueryError instances.
+    return await asyncio.gather(*[self.run(*query) for query in queries], return_exceptions=True)
+
+  async def _poll(self):
+    loop = asyncio.get_running_loop()
+    while self._pending:
+      next_check = min(check for _, _, check in self._pending.values())
+      self._wakeup.clear()
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), max(0, next_check - loop.time()))
+        continue
+      except asyncio.TimeoutError:
+        pass
+      now = loop.time()
+      due = [query_id for query_id, (_, _, check) in self._pending.items() if check <= now]
+      for start in range(0, len(due), BATCH_GET_LIMIT):
+        batch = due[start:start + BATCH_GET_LIMIT]
+        try:
+          response = await loop.run_in_executor(None, lambda: client.batch_get_query_execution(QueryExecutionIds=batch))
+        except Exception as e:
+          for query_id in batch:
+            self._pending.pop(query_id)[0].set_exception(e)
+          continue
+        for query_execution in response['QueryExecutions']:
+          self._update(query_execution, loop.time())
+        for unprocessed in response.get('UnprocessedQueryExecutionIds', []):
+          self._backoff(unprocessed['QueryExecutionId'], loop.time())
+
+  def _update(self, query_execution, now):
+    query_id = query_execution['QueryExecutionId']
+    state = query_execution['Status']['State']
+    if state == 'SUCCEEDED':
+      self._pending.pop(query_id)[0].set_result(query_execution)
+    elif state in FAILED_STATES:
+      self._pending.pop(query_id)[0].set_exception(AthenaQueryError(query_execution))
+    else:
+      self._backoff(query_id, now)
+
+  def _backoff(self, query_id, now):
+    pending = self._pending[query_id]
+    pending[1] = min(pending[1] * 2, self.max_delay)
+    pending[2] = now + pending[1]
+
+
+def run_queries(queries, max_concurrency=5):
+  return asyncio.run(AthenaExecutor(max_concurrency).run_all(queries))
+
+
+def result_columns(query_id):
+  # The first page of results carries the column names and types; one row is enough to get it.
+  response = client.get_query_results(QueryExecutionId=query_id, MaxResults=1)
+  return [(column['Name'], column['Type']) for column in response['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+
+
+def result_object(query_execution):
+  bucket, _, key = query_execution['ResultConfiguration']['OutputLocation'][len('s3://'):].partition('/')
+  return bucket, key
+
+
+def iter_result_frames(query_execution, chunk_rows=CHUNK_ROWS):
+  columns = result_columns(query_execution['QueryExecutionId'])
+  dtypes = dict((name, ATHENA_DTYPES.get(athena_type, 'string')) for name, athena_type in columns
+                if athena_type not in ATHENA_DATE_TYPES)
+  dates = [name for name, athena_type in columns if athena_type in ATHENA_DATE_TYPES]
+  bucket, key = result_object(query_execution)
+  body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+  try:
+    # read_csv pulls fixed size blocks from the stream as it goes, it never needs the whole object.
+    for frame in pd.read_csv(body, chunksize=chunk_rows, dtype=dtypes, parse_dates=dates):
+      yield frame
+  finally:
+    body.close()
+
+
+def run_query(sql, database, output_location, chunk_rows=CHUNK_ROWS):
+  query_execution = wait_for_query(start_query(sql, database, output_location))
+  return iter_result_frames(query_execution, chunk_rows)
+
+
+if __name__ == '__main__':
+  for frame in run_query(sql_query_string, 'census', query_bucket_url):
+    print(frame)
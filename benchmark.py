@@ -0,0 +1,364 @@
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import boto3
+import botocore.session
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+import sageDispatch
+
+# Benchmarks for the dispatch path, run against LocalS3, a stand-in for the s3 client calls involved that serves
+# objects from files in a temp directory and counts every GET and the bytes it returns. Nothing here talks to AWS. The
+# stand-in has no network in between, so against real s3 the bytes moved are what the times scale with.
+#
+#   python benchmark.py manifest --sizes-mb 1 100 1024
+#   python benchmark.py coldstart --runs 5
+#   python benchmark.py athena --size-mb 2048
+BENCH_BUCKET = 'bench'
+WRITE_BLOCK_BYTES = 1024 * 1024
+BENCH_MANIFEST = {
+  'TrainingJobName': 'census',
+  'HyperParameters': {'model_type': 'wide'},
+  'ResourceConfig': {'InstanceCount': 1, 'InstanceType': 'ml.p2.8xlarge', 'VolumeSizeInGB': 1},
+  'StoppingCondition': {'MaxRuntimeInSeconds': 86400},
+}
+# The fake credentials and the disabled metadata lookup keep botocore from going looking for real ones.
+BENCH_AWS_ENV = {
+  'AWS_DEFAULT_REGION': 'us-east-1',
+  'AWS_ACCESS_KEY_ID': 'bench',
+  'AWS_SECRET_ACCESS_KEY': 'bench',
+  'AWS_CONFIG_FILE': os.devnull,
+  'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+  'AWS_EC2_METADATA_DISABLED': 'true',
+}
+# What the dispatch Lambda gets from the template (see lambda_env in hydrate.py), pointed at made up resources.
+COLDSTART_ENV = dict(BENCH_AWS_ENV, **{
+  'APP_BUNDLE': 'source_action_output',
+  'TRAINING_IMAGE': '123456789012.dkr.ecr.us-east-1.amazonaws.com/census',
+  'SAGEMAKER_ROLE_ARN': 'arn:aws:iam::123456789012:role/bench',
+  'BUCKET_KEY_ARN': 'arn:aws:kms:us-east-1:123456789012:key/bench',
+  'INPUT_BUCKET': 's3://%s/input/' % BENCH_BUCKET,
+  'OUTPUT_BUCKET': 's3://%s/output/' % BENCH_BUCKET,
+})
+COLDSTART_ARTIFACT = 'coldstart.zip'
+# A query result the way Athena writes it: every field quoted, NULLs as empty fields. The rows repeat in blocks of
+# ATHENA_BLOCK_ROWS, which is enough variety for the parser and lets gigabytes be written at disk speed.
+ATHENA_RESULT = 'athena-result.csv'
+ATHENA_COLUMNS = [('id', 'bigint'), ('name', 'varchar'), ('age', 'integer'), ('score', 'double'),
+                  ('member', 'boolean'), ('signup', 'date')]
+ATHENA_BLOCK_ROWS = 10000
+
+
+class LocalS3(object):
+  """Serves get_object, with Range and IfMatch, from the files under root, one directory per bucket.
+
+  gets and bytes count the requests made and the body bytes read since the last reset().
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self.reset()
+
+  def reset(self):
+    self.gets = 0
+    self.bytes = 0
+
+  def path(self, bucket, key):
+    return os.path.join(self.root, bucket, key)
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+    path = self.path(Bucket, Key)
+    stat = os.stat(path)
+    etag = '"%x-%x"' % (stat.st_size, int(stat.st_mtime))
+    if IfMatch and IfMatch != etag:
+      raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'etag changed'}}, 'GetObject')
+    start, end = 0, stat.st_size - 1
+    if Range:
+      first, last = re.match(r'bytes=(\d*)-(\d*)$', Range).groups()
+      if not first:
+        start = max(0, stat.st_size - int(last))
+      else:
+        start, end = int(first), min(int(last), end) if last else end
+    self.gets += 1
+    body = open(path, 'rb')
+    body.seek(start)
+    response = {'Body': CountingBody(body, end - start + 1, self), 'ETag': etag, 'ContentLength': end - start + 1}
+    if Range:
+      response['ContentRange'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+    return response
+
+
+class CountingBody(object):
+
+  def __init__(self, stream, length, s3):
+    self.stream = stream
+    self.remaining = length
+    self.s3 = s3
+
+  def read(self, size=-1):
+    if size is None or size < 0 or size > self.remaining:
+      size = self.remaining
+    data = self.stream.read(size)
+    self.remaining -= len(data)
+    self.s3.bytes += len(data)
+    return data
+
+  def close(self):
+    self.stream.close()
+
+
+def write_random(out, size):
+  # Random bytes don't compress, so a stored member costs its full size in the archive, like vendored data does.
+  while size > 0:
+    block = os.urandom(min(size, WRITE_BLOCK_BYTES))
+    out.write(block)
+    size -= len(block)
+
+
+def build_artifact(path, size):
+  # manifest.json goes first, as far from the zip index at the end as it can be.
+  with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as artifact:
+    artifact.writestr('manifest.json', json.dumps(BENCH_MANIFEST, indent=2))
+    with artifact.open('data/vendored.bin', 'w', force_zip64=True) as member:
+      write_random(member, size)
+
+
+def full_download_manifest(s3, bucket, key):
+  # What get_manifest_from_s3 did before it read ranges: the whole artifact to a temp file, then zipfile on that.
+  with tempfile.NamedTemporaryFile() as tmp_file:
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    shutil.copyfileobj(body, tmp_file, WRITE_BLOCK_BYTES)
+    body.close()
+    tmp_file.flush()
+    with zipfile.ZipFile(tmp_file.name, 'r') as artifact:
+      return artifact.read('manifest.json')
+
+
+def ranged_manifest(s3, bucket, key):
+  sageDispatch._clients['s3'] = s3
+  return sageDispatch.get_manifest_from_s3(bucket, key)[0]
+
+
+def benchmark_manifest(sizes_mb, directory):
+  s3 = LocalS3(directory)
+  os.makedirs(os.path.join(directory, BENCH_BUCKET))
+  for size_mb in sizes_mb:
+    key = 'artifact-%dmb.zip' % size_mb
+    build_artifact(s3.path(BENCH_BUCKET, key), size_mb * 1024 * 1024)
+    manifests = []
+    for label, fetch in (('ranged', ranged_manifest), ('full download', full_download_manifest)):
+      s3.reset()
+      started = time.time()
+      manifests.append(fetch(s3, BENCH_BUCKET, key))
+      print('%6d MB artifact, %-14s %3d GETs %13d bytes %8.3fs' % (size_mb, label + ':', s3.gets, s3.bytes,
+                                                                     time.time() - started))
+    if manifests[0] != manifests[1]:
+      raise AssertionError('the two reads disagree on manifest.json in %s' % key)
+    os.remove(s3.path(BENCH_BUCKET, key))
+
+
+def import_time():
+  # -X importtime reports every module as "import time: self [us] | cumulative | name"; sageDispatch's cumulative time
+  # is the whole import, boto3 included.
+  output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sageDispatch'], check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+                          universal_newlines=True).stderr
+  modules = {}
+  for line in output.splitlines():
+    match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$', line)
+    if match:
+      modules[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+  return modules['sageDispatch'][1] / 1e6, sorted(modules.items(), key=lambda item: -item[1][0])
+
+
+def fake_responses(s3, key):
+  # Canned parsed responses for everything a first dispatch calls, keyed by operation. They are handed back from
+  # before-call, so the real clients are still built, load their service models and serialize every request.
+  def get_object(request):
+    return s3.get_object(Bucket=BENCH_BUCKET, Key=key, Range=request['headers'].get('Range'),
+                         IfMatch=request['headers'].get('If-Match'))
+
+  def list_object_versions(request):
+    size = os.path.getsize(s3.path(BENCH_BUCKET, key))
+    return {'IsTruncated': False,
+            'Versions': [{'Key': 'input/train.csv', 'VersionId': 'v1', 'IsLatest': True, 'Size': size, 'ETag': '"e"'}]}
+
+  return {
+    'GetObject': get_object,
+    'ListObjectVersions': list_object_versions,
+    'DescribeImages': lambda request: {'imageDetails': [{'imageDigest': 'sha256:' + '0' * 64}]},
+    'CreateTrainingJob': lambda request: {'TrainingJobArn': 'arn:aws:sagemaker:us-east-1:123456789012:training-job/b'},
+    'PutJobSuccessResult': lambda request: {},
+    'PutJobFailureResult': lambda request: {},
+  }
+
+
+def first_invocation(directory):
+  # Runs in a fresh process with sageDispatch already imported, so the first call pays what a cold Lambda pays after
+  # its imports: the session, each client, its service model and endpoint rules, and the thread pool spinning up.
+  s3 = LocalS3(directory)
+  responses = fake_responses(s3, COLDSTART_ARTIFACT)
+  calls = []
+
+  def respond(model, params, **kwargs):
+    calls.append(model.name)
+    return AWSResponse('https://bench', 200, {}, None), responses[model.name](params)
+
+  job_data = {'inputArtifacts': [{'name': 'source_action_output', 'revision': 'c0ffee', 'location': {
+    's3Location': {'bucketName': BENCH_BUCKET, 'objectKey': COLDSTART_ARTIFACT}}}]}
+  timings = []
+  for attempt in range(2):
+    started = time.time()
+    if sageDispatch._session is None:
+      sageDispatch._session = boto3.session.Session(botocore_session=botocore.session.get_session())
+      sageDispatch._session.events.register('before-call', respond)
+    sageDispatch.process_job('job-%d' % attempt, job_data)
+    timings.append(time.time() - started)
+  if 'PutJobFailureResult' in calls:
+    raise AssertionError('the dispatch failed; calls made: %s' % ', '.join(calls))
+  print(json.dumps({'first': timings[0], 'second': timings[1], 'calls': len(calls)}))
+
+
+def benchmark_coldstart(runs, directory):
+  os.makedirs(os.path.join(directory, BENCH_BUCKET))
+  build_artifact(os.path.join(directory, BENCH_BUCKET, COLDSTART_ARTIFACT), 1024 * 1024)
+  env = dict(os.environ, **COLDSTART_ENV)
+  imports, firsts, seconds = [], [], []
+  for run in range(runs):
+    seconds_to_import, modules = import_time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--dir', directory, 'coldstart', '--child'],
+                            check=True, env=env, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    invocation = json.loads(output.splitlines()[-1])
+    imports.append(seconds_to_import)
+    firsts.append(invocation['first'])
+    seconds.append(invocation['second'])
+    print('run %d: import sageDispatch %.3fs, first process_job %.3fs, second %.3fs (%d calls)' % (
+      run + 1, seconds_to_import, invocation['first'], invocation['second'], invocation['calls']))
+  print('median: import sageDispatch %.3fs, first process_job %.3fs, second %.3fs' % (
+    statistics.median(imports), statistics.median(firsts), statistics.median(seconds)))
+  print('slowest imports of the last run, by self time:')
+  for name, (self_us, cumulative_us) in modules[:10]:
+    print('  %-40s %8.1fms self %8.1fms cumulative' % (name, self_us / 1e3, cumulative_us / 1e3))
+
+
+def build_athena_result(path, size):
+  block = ''.join('"%d","user %d","%s","%.4f","%s","2018-%02d-%02d"\n' % (
+    row, row, '' if row % 17 == 0 else row % 90, row / 7.0, 'true' if row % 2 else 'false', row % 12 + 1, row % 28 + 1)
+    for row in range(ATHENA_BLOCK_ROWS)).encode('utf-8')
+  with open(path, 'wb') as out:
+    out.write((','.join('"%s"' % name for name, _ in ATHENA_COLUMNS) + '\n').encode('utf-8'))
+    written = 0
+    while written < size:
+      out.write(block)
+      written += len(block)
+
+
+class FakeAthena(object):
+  """Answers get_query_results, the one Athena call iter_result_frames makes, with ATHENA_COLUMNS as the metadata."""
+
+  def get_query_results(self, QueryExecutionId, MaxResults=None):
+    return {'ResultSet': {'ResultSetMetadata': {'ColumnInfo': [{'Name': name, 'Type': athena_type}
+                                                               for name, athena_type in ATHENA_COLUMNS]}}}
+
+
+class FullReadS3(object):
+  """What athena_query did before it streamed: the whole object through Body.read() before anything parses it.
+
+  Parsing then goes through iter_result_frames in a single chunk, with the same dtypes, so the comparison is down to
+  how the object is read.
+  """
+
+  def __init__(self, s3):
+    self.s3 = s3
+
+  def get_object(self, **kwargs):
+    response = self.s3.get_object(**kwargs)
+    return dict(response, Body=io.BytesIO(response['Body'].read()))
+
+
+def read_athena_result(directory, approach):
+  # Runs in a process of its own, so ru_maxrss is the peak of this approach alone.
+  import athena_query
+  athena_query.client = FakeAthena()
+  s3 = LocalS3(directory)
+  query_execution = {'QueryExecutionId': 'bench',
+                     'ResultConfiguration': {'OutputLocation': 's3://%s/%s' % (BENCH_BUCKET, ATHENA_RESULT)}}
+  baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  started = time.time()
+  if approach == 'streamed':
+    athena_query.s3_client = s3
+    frames = athena_query.iter_result_frames(query_execution)
+  else:
+    athena_query.s3_client = FullReadS3(s3)
+    frames = athena_query.iter_result_frames(query_execution, chunk_rows=sys.maxsize)
+  rows = sum(len(frame) for frame in frames)
+  print(json.dumps({'rows': rows, 'bytes': s3.bytes, 'seconds': time.time() - started, 'baseline_kb': baseline_kb,
+                    'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def benchmark_athena(size_mb, directory):
+  os.makedirs(os.path.join(directory, BENCH_BUCKET))
+  build_athena_result(os.path.join(directory, BENCH_BUCKET, ATHENA_RESULT), size_mb * 1024 * 1024)
+  env = dict(os.environ, **BENCH_AWS_ENV)
+  for approach in ('streamed', 'full read'):
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), '--dir', directory, 'athena', '--child',
+                            approach], env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    if child.returncode != 0:
+      # A full read that doesn't fit in memory is killed by the kernel, which is the result worth reporting.
+      print('%6d MB result, %-11s failed with exit status %d' % (size_mb, approach + ':', child.returncode))
+      continue
+    result = json.loads(child.stdout.splitlines()[-1])
+    print('%6d MB result, %-11s %10d rows %7.1f MB/s  peak RSS %7.1f MB (%.1f MB after imports)' % (
+      size_mb, approach + ':', result['rows'], result['bytes'] / 1048576.0 / result['seconds'],
+      result['peak_kb'] / 1024.0, result['baseline_kb'] / 1024.0))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the dispatch path against a local s3 stand-in.')
+  parser.add_argument('--dir', help='scratch directory for the generated objects (default: a new temp dir)')
+  commands = parser.add_subparsers(dest='command', required=True)
+  manifest_command = commands.add_parser('manifest', help='read manifest.json out of pipeline artifacts')
+  manifest_command.add_argument('--sizes-mb', type=int, nargs='+', default=[1, 100, 1024], metavar='MB',
+                                help='artifact sizes (default: %(default)s)')
+  coldstart_command = commands.add_parser('coldstart', help='import sageDispatch and run a first process_job')
+  coldstart_command.add_argument('--runs', type=int, default=5, help='fresh processes to time (default: %(default)s)')
+  coldstart_command.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+  athena_command = commands.add_parser('athena', help='read a query result into DataFrames, streamed and whole')
+  athena_command.add_argument('--size-mb', type=int, default=2048, metavar='MB',
+                              help='size of the synthetic result (default: %(default)s)')
+  athena_command.add_argument('--child', choices=('streamed', 'full read'), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.command == 'coldstart' and args.child:
+    first_invocation(args.dir)
+    return
+  if args.command == 'athena' and args.child:
+    read_athena_result(args.dir, args.child)
+    return
+  directory = args.dir or tempfile.mkdtemp(prefix='sagedispatch-bench-')
+  try:
+    if args.command == 'manifest':
+      benchmark_manifest(args.sizes_mb, directory)
+    elif args.command == 'coldstart':
+      benchmark_coldstart(args.runs, directory)
+    elif args.command == 'athena':
+      benchmark_athena(args.size_mb, directory)
+  finally:
+    if not args.dir:
+      shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+import sageDispatch
+from sageDispatch import client
+
+log = logging.getLogger()
+
+# Runs as a pipeline action in the same stage as the image build, so a manifest that can't be dispatched or a channel
+# with no data under it fails the execution while the image is still building, instead of after it, when the Train
+# action would have failed on it anyway. Each distinct channel source costs one request however big the data under it
+# is: a listing of at most one key for prefixes, a HEAD for manifest files. The full versioned listing is left to
+# sageDispatch, which needs it for the data snapshot.
+REQUIRED_JOB_KEYS = ('ResourceConfig', 'StoppingCondition')
+
+
+def handler(event, context):
+  sageDispatch.configure_logging()
+  log.debug(event)
+  job = event['CodePipeline.job']
+  codepipeline = client('codepipeline')
+  try:
+    problems = validate(sageDispatch.get_manifest_dictionary(job['data']['inputArtifacts']))
+  except Exception as e:
+    log.critical(e)
+    problems = ['could not read the manifest: %s' % e]
+  if problems:
+    sageDispatch.put_job_failure(job['id'], '; '.join(['Data validation failed.'] + problems), codepipeline)
+  else:
+    sageDispatch.put_job_success(job['id'], 'Manifest and input channels look good.', codepipeline)
+  return problems
+
+
+def validate(manifest):
+  # Returns a description of everything wrong with the manifest and its input data; empty when there is nothing.
+  problems = []
+  names = [job.get('Name') for job in manifest.get('Jobs', [])]
+  if not manifest.get('TrainingJobName'):
+    return ['the manifest has no TrainingJobName']
+  if 'Jobs' in manifest and not names:
+    return ['the manifest has an empty Jobs list']
+  if None in names:
+    return ['every entry of Jobs needs a Name']
+  if len(set(names)) != len(names):
+    problems.append('job names repeat: %s' % ', '.join(sorted(set(n for n in names if names.count(n) > 1))))
+  sources = {}
+  for spec in sageDispatch.job_specs(manifest):
+    label = spec['TrainingJobName']
+    problems.extend('%s has no %s' % (label, key) for key in REQUIRED_JOB_KEYS if not spec.get(key))
+    if spec.get('StoppingCondition'):
+      try:
+        sageDispatch.stopping_condition(spec)
+      except ValueError as e:
+        problems.append(str(e))
+    problems.extend('%s has a non string value for hyperparameter %s' % (label, name)
+                    for name, value in sorted(spec.get('HyperParameters', {}).items()) if not isinstance(value, str))
+    for channel in sageDispatch.job_channels(spec):
+      source = channel['DataSource']['S3DataSource']
+      sources.setdefault((source['S3Uri'], source['S3DataType']), []).append(label)
+  futures = dict((source, sageDispatch.executor.submit(has_data, *source)) for source in sources)
+  for (uri, data_type), future in sorted(futures.items()):
+    if not future.result():
+      problems.append('no data at %s (used by %s)' % (uri, ', '.join(sorted(set(sources[uri, data_type])))))
+  return problems
+
+
+def has_data(uri, data_type='S3Prefix'):
+  bucket, _, key = uri[len('s3://'):].partition('/')
+  if data_type != 'S3Prefix':
+    try:
+      client('s3').head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+        return False
+      raise
+    return True
+  return client('s3').list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1).get('KeyCount', 0) > 0
@@ -0,0 +1,114 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# Copies a dataset into the (versioned) input bucket, uploading only the files whose bytes changed. Each object
+# carries the sha256 of its content in its metadata; a file whose hash matches the object already there is left
+# alone, so its version id, and with it the data snapshot sageDispatch tags and fingerprints jobs with, stays the same
+# and the job index can reuse the job trained on it. Files are hashed and checked several at a time, and each upload is
+# itself a parallel multipart upload once it is past one part.
+HASH_METADATA = 'sha256'
+HASH_BLOCK_BYTES = 1024 * 1024
+PART_BYTES = 64 * 1024 * 1024
+SYNC_WORKERS = 8
+TRANSFER_WORKERS = 4
+
+
+def file_sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as data:
+    for block in iter(lambda: data.read(HASH_BLOCK_BYTES), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def head(s3_client, bucket, key):
+  try:
+    return s3_client.head_object(Bucket=bucket, Key=key)
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+      return None
+    raise
+
+
+def sync_file(s3_client, bucket, key, path, transfer_config, dry_run=False):
+  digest = file_sha256(path)
+  existing = head(s3_client, bucket, key)
+  if existing is not None and existing.get('Metadata', {}).get(HASH_METADATA) == digest:
+    return {'Key': key, 'Status': 'Unchanged', 'VersionId': existing.get('VersionId'), 'Bytes': 0}
+  size = os.path.getsize(path)
+  if dry_run:
+    return {'Key': key, 'Status': 'Changed' if existing else 'New', 'VersionId': None, 'Bytes': size}
+  s3_client.upload_file(path, bucket, key, ExtraArgs={'Metadata': {HASH_METADATA: digest}}, Config=transfer_config)
+  # upload_file doesn't hand back the response, so ask for the version that was just written.
+  return {'Key': key, 'Status': 'Uploaded', 'VersionId': head(s3_client, bucket, key).get('VersionId'), 'Bytes': size}
+
+
+def local_files(sources):
+  # A directory contributes every file under it, keyed by its path relative to the directory; a file is keyed by its
+  # name.
+  for source in sources:
+    if os.path.isdir(source):
+      for root, dirs, names in os.walk(source):
+        dirs.sort()
+        for name in sorted(names):
+          path = os.path.join(root, name)
+          yield path, os.path.relpath(path, source).replace(os.sep, '/')
+    else:
+      yield source, os.path.basename(source)
+
+
+def sync(sources, bucket, prefix='', workers=SYNC_WORKERS, part_bytes=PART_BYTES, transfer_workers=TRANSFER_WORKERS,
+         dry_run=False, s3_client=None):
+  s3_client = s3_client or boto3.client('s3')
+  transfer_config = TransferConfig(multipart_threshold=part_bytes, multipart_chunksize=part_bytes,
+                                   max_concurrency=transfer_workers)
+  files = {}
+  for path, key in local_files(sources):
+    if files.setdefault(key, path) != path:
+      raise ValueError('%s and %s would both be uploaded to %s' % (files[key], path, prefix + key))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(sync_file, s3_client, bucket, prefix + key, path, transfer_config, dry_run)
+               for key, path in sorted(files.items())]
+    return [future.result() for future in futures]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Upload the files of a dataset whose content changed to s3.')
+  parser.add_argument('sources', nargs='+', metavar='SOURCE', help='directories and files to sync')
+  parser.add_argument('destination', help='s3://bucket/prefix/ to sync into')
+  parser.add_argument('--workers', type=int, default=SYNC_WORKERS,
+                      help='files hashed and uploaded at once (default: %(default)s)')
+  parser.add_argument('--transfer-workers', type=int, default=TRANSFER_WORKERS,
+                      help='parts uploaded at once for each file (default: %(default)s)')
+  parser.add_argument('--part-mb', type=int, default=PART_BYTES // (1024 * 1024),
+                      help='multipart part size in MB, at least 5 (default: %(default)s)')
+  parser.add_argument('--dry-run', action='store_true', help='only report what would be uploaded')
+  args = parser.parse_args()
+
+  if args.part_mb < 5:
+    parser.error('--part-mb has to be at least 5')
+  if not args.destination.startswith('s3://'):
+    parser.error('destination has to be an s3:// url')
+  bucket, _, prefix = args.destination[len('s3://'):].partition('/')
+  if prefix and not prefix.endswith('/'):
+    prefix += '/'
+
+  results = sync(args.sources, bucket, prefix, args.workers, args.part_mb * 1024 * 1024, args.transfer_workers,
+                 args.dry_run)
+  print(json.dumps({
+    'Objects': results,
+    'Uploaded': sum(1 for result in results if result['Status'] != 'Unchanged'),
+    'Unchanged': sum(1 for result in results if result['Status'] == 'Unchanged'),
+    'UploadedBytes': sum(result['Bytes'] for result in results),
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,188 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+import sageDispatch
+
+# A long running job worker for a custom CodePipeline action. It polls for jobs, acknowledges them and runs each one
+# through the same code the sageDispatch Lambda uses, several at a time. Run it on anything with a role that can read
+# the pipeline artifact bucket, the input bucket and ECR and can call sagemaker; the environment variables are the same
+# ones hydrate.py sets on the Lambda. Register the action type once with
+#
+#   aws codepipeline create-custom-action-type --category Build --provider SageMakerDispatch --action-version 1 \
+#     --input-artifact-details minimumCount=1,maximumCount=1 --output-artifact-details minimumCount=0,maximumCount=0
+#
+# and point poll-for-jobs.json at it. With --local-jobs the worker serves CodePipeline Lambda events (like event.json)
+# from a LocalCodePipeline instead, which is how you try it out without a pipeline.
+
+log = logging.getLogger()
+
+# A failed poll or acknowledgement (throttling, a dropped connection) is logged and the worker backs off, doubling the
+# wait from the poll interval up to POLL_BACKOFF_CAP_SECONDS, instead of going down. Jobs that were handed out but not
+# acknowledged are handed out again by CodePipeline.
+POLL_BACKOFF_CAP_SECONDS = 60
+RETRYABLE_POLL_ERRORS = (ClientError, ConnectionError, HTTPClientError)
+
+
+class Worker(object):
+
+  def __init__(self, codepipeline, action_type_id, max_workers=8, poll_interval=5):
+    self.codepipeline = codepipeline
+    self.action_type_id = action_type_id
+    self.max_workers = max_workers
+    self.poll_interval = poll_interval
+    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    self._in_flight = set()
+    self._lock = threading.Lock()
+
+  def run(self, until=None):
+    # until is checked whenever a poll comes back empty with nothing in flight; the default is to run forever.
+    failures = 0
+    try:
+      while True:
+        try:
+          polled = self.poll_once()
+        except RETRYABLE_POLL_ERRORS as e:
+          failures += 1
+          backoff = min(POLL_BACKOFF_CAP_SECONDS, self.poll_interval * 2 ** failures)
+          log.warning("polling failed (%s), trying again in %.1fs", e, backoff)
+          time.sleep(backoff)
+          continue
+        failures = 0
+        if until is not None and not polled and not self._in_flight and until():
+          return
+        if not polled:
+          time.sleep(self.poll_interval)
+    finally:
+      self._pool.shutdown(wait=True)
+
+  def poll_once(self):
+    # Only ask for as many jobs as there are free workers, so an acknowledged job never waits in our queue.
+    free = self.max_workers - len(self._in_flight)
+    if free <= 0:
+      return 0
+    jobs = self.codepipeline.poll_for_jobs(actionTypeId=self.action_type_id, maxBatchSize=min(free, 100))['jobs']
+    for job in jobs:
+      response = self.codepipeline.acknowledge_job(jobId=job['id'], nonce=job['nonce'])
+      if response['status'] != 'InProgress':
+        log.warning("job %s was %s by the time we acknowledged it", job['id'], response['status'])
+        continue
+      with self._lock:
+        self._in_flight.add(job['id'])
+      self._pool.submit(self.process, job)
+    return len(jobs)
+
+  def process(self, job):
+    try:
+      log.info("processing job %s", job['id'])
+      sageDispatch.process_job(job['id'], job['data'], self.codepipeline)
+    finally:
+      with self._lock:
+        self._in_flight.discard(job['id'])
+
+
+class LocalCodePipeline(object):
+  """In-memory stand-in for the CodePipeline job worker API.
+
+  Jobs are fed in with add_job and handed out by poll_for_jobs. A success result with a continuation token puts the
+  job back on the queue, carrying the token, after continuation_delay seconds, the way CodePipeline would. Final
+  results are kept in results, keyed by job id.
+  """
+
+  def __init__(self, continuation_delay=0):
+    self.continuation_delay = continuation_delay
+    self.results = {}
+    self._queue = collections.deque()
+    self._polled = {}
+    self._acknowledged = set()
+    self._lock = threading.Lock()
+
+  def add_job(self, data, job_id=None, not_before=0):
+    job = {'id': job_id or str(uuid.uuid4()), 'nonce': str(uuid.uuid4()), 'accountId': '000000000000', 'data': data}
+    with self._lock:
+      self._queue.append((not_before, job))
+    return job['id']
+
+  def poll_for_jobs(self, actionTypeId, maxBatchSize=1, queryParam=None):
+    now = time.time()
+    jobs = []
+    with self._lock:
+      for _ in range(len(self._queue)):
+        not_before, job = self._queue.popleft()
+        if not_before <= now and len(jobs) < maxBatchSize:
+          self._polled[job['id']] = job['data']
+          jobs.append(job)
+        else:
+          self._queue.append((not_before, job))
+    return {'jobs': jobs}
+
+  def acknowledge_job(self, jobId, nonce):
+    with self._lock:
+      self._acknowledged.add(jobId)
+    return {'status': 'InProgress'}
+
+  def put_job_success_result(self, jobId, currentRevision=None, continuationToken=None, executionDetails=None,
+                             outputVariables=None):
+    self._check_acknowledged(jobId)
+    if continuationToken:
+      log.info("job %s continues: %s", jobId, (executionDetails or {}).get('summary'))
+      data = dict(self._polled[jobId], continuationToken=continuationToken)
+      self.add_job(data, jobId, time.time() + self.continuation_delay)
+    else:
+      self.results[jobId] = {'status': 'Succeeded', 'executionDetails': executionDetails}
+
+  def put_job_failure_result(self, jobId, failureDetails):
+    self._check_acknowledged(jobId)
+    self.results[jobId] = {'status': 'Failed', 'failureDetails': failureDetails}
+
+  def idle(self):
+    with self._lock:
+      return not self._queue
+
+  def _check_acknowledged(self, jobId):
+    with self._lock:
+      if jobId not in self._acknowledged:
+        raise ValueError('job %s was never acknowledged' % jobId)
+      self._acknowledged.discard(jobId)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Poll CodePipeline for sageDispatch jobs and send them to SageMaker.')
+  parser.add_argument('--action-type', default='poll-for-jobs.json',
+                      help='JSON file holding the actionTypeId to poll for (default: %(default)s)')
+  parser.add_argument('--workers', type=int, default=8, help='jobs processed at once (default: %(default)s)')
+  parser.add_argument('--poll-interval', type=float, default=5,
+                      help='seconds to wait after an empty poll (default: %(default)s)')
+  parser.add_argument('--local-jobs', nargs='+', metavar='EVENT',
+                      help='serve these CodePipeline Lambda events from a local stand-in and exit once all finish')
+  args = parser.parse_args()
+
+  sageDispatch.configure_logging()
+  with open(args.action_type) as action_type_file:
+    action_type_id = json.load(action_type_file)['actionTypeId']
+  if args.local_jobs:
+    codepipeline = LocalCodePipeline(continuation_delay=args.poll_interval)
+    for path in args.local_jobs:
+      with open(path) as event_file:
+        job = json.load(event_file)['CodePipeline.job']
+      codepipeline.add_job(job['data'], job['id'])
+  else:
+    codepipeline = boto3.client('codepipeline')
+  worker = Worker(codepipeline, action_type_id, args.workers, args.poll_interval)
+  if args.local_jobs:
+    worker.run(until=codepipeline.idle)
+    print(json.dumps(codepipeline.results, indent=2, default=str))
+  else:
+    worker.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,25 @@
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
 from troposphere.constants import NUMBER
-from troposphere import Output, Ref, Template, Parameter, GetAtt, Join
+from troposphere import Output, Ref, Template, Parameter, GetAtt, Join, Equals, If
 from troposphere.kms import Key
 from troposphere.s3 import Bucket, ServerSideEncryptionByDefault, BucketEncryption, ServerSideEncryptionRule, VersioningConfiguration
+from troposphere.s3 import NotificationConfiguration, EventBridgeConfiguration
 from troposphere.codecommit import Repository
-from troposphere.awslambda import Function, Code, MEMORY_VALUES, Environment as Lambda_Environment
+from troposphere.awslambda import Function, Code, MEMORY_VALUES, Environment as Lambda_Environment, Permission
 from troposphere.iam import Role, Policy
 from troposphere.codepipeline import (
     Pipeline, Stages, Actions, ActionTypeID, OutputArtifacts, InputArtifacts,
     ArtifactStore)
-from troposphere.codebuild import Project, Artifacts, Environment, Source
+from troposphere.codebuild import Project, Artifacts, Environment, Source, ProjectCache
 from troposphere.ecr import Repository as Docker_Repo
 from troposphere.events import Rule, Target
 
@@ -23,744 +34,1352 @@ from troposphere.events import Rule, Target
 # certain that the bucket is referred to in the "lambda_function_bucket" variable.
 
 
-# CFN Template
-t = Template()
-t.add_description("This template hydrates a machine learning pipeline.")
-
-
-# The name of the ml project you're working on
-project_name_parameter = t.add_parameter(Parameter(
-    'projectnameparameter',
-    Type='String',
-    Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mlworkflow'
-))
-region_parameter = t.add_parameter(Parameter(
-    'regionparameter',
-    Type='String',
-    Description='This is the region in which you are deploying this template.',
-    MinLength='1',
-    Default='us-west-2'
-))
-
-
-# This is to ensure that buckets created by the cfn template are unique
-account_parameter = t.add_parameter(Parameter(
-    'accountparameter',
-    Type='Number',
-    Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
-    MinValue='12'
-))
-
-# buckets used to store machine learning dataset. Anything in here will be served up to the sagemaker containers
-input_bucket_parameter = t.add_parameter(Parameter(
-    'inputbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that holds your machine learning training and testing datasets.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='inputbucket'
-))
-
-output_bucket_parameter = t.add_parameter(Parameter(
-    'outputbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that will receive the output of your machine learning training model.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='outputbucket'
-))
-
-# the name of the pipeline that gets created by this cfn template and the name of the bucket used for the pipeline
-# the name of the artificats that  hold the codecommit code the pipeline downloads.
-pipeline_name_parameter = t.add_parameter(Parameter(
-    'pipelinenameparameter',
-    Type='String',
-    Description='This is the name the pipeline that is going to move the model from the repo to training in sagemaker.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='pipeline'
-))
-
-# the name of the codecommmit repo where machine learning code gets commited to
-# The name of the codebuild project that creates the docker container
-
-repo_name_parameter = t.add_parameter(Parameter(
-    'reponameparameter',
-    Type='String',
-    Description='This is the name of the code commit repo that will be watched to trigger the pipeline as the model is revised and commited.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mlrepo'
-))
-
-# the name of the ecr registory that contains the docker container built for submission to sagemaker
-ml_docker_registry_name_parameter = t.add_parameter(Parameter(
-    'mldockerregistrynameparameter',
-    Type='String',
-    Description='This is the name of the ecr registry used to contain the docker image with your model code.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mldockerrepo'
-))
-
-# variables for the name of the lambda function that gets invovked to send the container to training.
-lambda_function_bucket_parameter = t.add_parameter(Parameter(
-    'lambdafunctionbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that contains the lambda function used to send your model into SageMaker.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='lambdabucket'
-))
-
-loglevelparameter = t.add_parameter(Parameter(
-    'loglevelparameter',
-    Type='String',
-    Description='This is the logging parameter used for the lambda function used to send your model into SageMaker',
-    MinLength='1',
-    AllowedValues=['DEBUG', 'INFO','WARNING', 'ERROR','CRITICAL'],
-    Default='WARNING'
-))
-
-# KMS key used to encrypted the input and output bucks that contain the data sets
-projectkmskeyparameter = t.add_parameter(Parameter(
-    'projectkmskeyparameter',
-    Type='String',
-    Description='This kms key is used to encrypt both the input and output buckets.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='kmskey'
-))
-
-
-t.add_metadata({
-    'AWS::CloudFormation::Interface': {
-        'ParameterGroups': [
-            {
-                'Label': {'default': 'General project configuration'},
-                'Parameters': ['accountparameter', 'regionparameter', 'projectnameparameter']
-            },
-            {
-                'Label': {'default': 'Encryption'},
-                'Parameters': ['projectkmskeyparameter']
-            },
-            {
-                'Label': {'default': 'Input and output s3 buckets for training, testing, and evaultion data.'},
-                'Parameters': ['inputbucketparameter', 'outputbucketparameter']
-            },
-            {
-                'Label': {'default': 'CI/CD Pipeline information'},
-                'Parameters': ['pipelinenameparameter', 'reponameparameter', 'mldockerregistrynameparameter']
-            },
-{
-                'Label': {'default': 'Lambda function information'},
-                'Parameters': ['lambdafunctionbucketparameter', 'loglevelparameter']
-            }
-        ],
-        'ParameterLabels': {
-            'accountparameter': {'default': 'Account ID'},
-            'regionparameter': {'default': 'Region'},
-            'projectnameparameter': {'default': 'Project name'},
-            'projectkmskeyparameter': {'default': 'KMS key name'},
-            'inputbucketparameter': {'default': 'Model input bucket name'},
-            'outputbucketparameter': {'default': 'Model output bucket name'},
-            'pipelinenameparameter': {'default': 'Name of the CodePipeline pipeline'},
-            'reponameparameter': {'default': 'Name of the CodeCommit repo'},
-            'mldockerregistrynameparameter': {'default': 'Name of the ECR registry'},
-            'lambdafunctionbucketparameter': {'default': 'Name of the S3 bucket that contains the lambda function zip file called sageDispatch.zip.'},
-            'loglevelparameter': {'default': 'The Lambda logging level to use for this function. Default is set to Warning.'}
-        }
-    }
-})
-
-# Add the project's kms key to the cfn template
-project_key = t.add_resource(Key('projectkey',
-                                 Description='Key used for ML pipeline',
-                                 Enabled=True,
-                                 EnableKeyRotation=True,
-                                 KeyPolicy={
-                                     "Version": "2012-10-17",
-                                     "Id": 'mlkey',
-                                     "Statement": [
-                                         {
-                                             "Sid": "Enable IAM User Permissions",
-                                             "Effect": "Allow",
-                                             "Principal": {
-                                                 "AWS": Join(":", ["arn:aws:iam:", Ref("AWS::AccountId"), "root"])
-                                                },
-                                             "Action": "kms:*",
-                                             "Resource": "*"
-                                         }]
-                                 }
-                                 ))
-
-#Encryption configs for input and output buckets
-bucket_encryption_config = ServerSideEncryptionByDefault(
-    KMSMasterKeyID=GetAtt('projectkey', "Arn"),
-    SSEAlgorithm='aws:kms')
-
-bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=bucket_encryption_config)
-bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[bucket_encryption_rule])
-
-#Encryption configs for codepipeline bucket
-cp_bucket_encryption_config = ServerSideEncryptionByDefault(
-    SSEAlgorithm='AES256')
-
-cp_bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=cp_bucket_encryption_config)
-cp_bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[cp_bucket_encryption_rule])
-
-
-input_bucket = t.add_resource(Bucket(
-    'InputBucket',
-    AccessControl='Private',
-    BucketName=Join("", [Ref("accountparameter"), Ref("inputbucketparameter")]),
-    #BucketEncryption=cp_bucket_encryption,
-    VersioningConfiguration=VersioningConfiguration(Status='Enabled')
-))
-
-output_bucket = t.add_resource(Bucket(
-    'OutputBucket',
-    AccessControl='Private',
-    BucketName=Join("", [Ref("accountparameter"), Ref("outputbucketparameter")])
-    #BucketEncryption=cp_bucket_encryption,
-    #DependsOn='CodePipelineBucket'
-))
-
-codepipeline_artifact_store_bucket = t.add_resource(Bucket(
-    'CodePipelineBucket',
-    AccessControl='Private',
-    BucketName=Join('', [Ref('accountparameter'), Ref('projectnameparameter'), 'artifactstore']),
-    BucketEncryption=bucket_encryption
-
-))
-
-# Add ecr repo to the cfn template
-ml_docker_repo = t.add_resource(Docker_Repo('mlrepo', RepositoryName=Ref('mldockerregistrynameparameter')))
-
-# Add codecommit repo
-repo = t.add_resource(Repository('Repository', RepositoryDescription='ML repo', RepositoryName=Ref('reponameparameter')))
-
-
-# Start to build out the codeBuild portion of the solution. This part of the pipeline relies on dockerfile being present
-# in the codecommit repo that the pipeline passes onto it. The build details should also be contained in a buildspec.yml
-# file that is also located in the same repo. The buildspec file will use the docker file to create a container based on
-# the dockerfile and then tag it with the commit id that triggered the pipeline. Once the build is complete it will push
-# it to ecr.
-code_build_artifacts = Artifacts(Type='CODEPIPELINE')
-
-environment = Environment(
-    ComputeType='BUILD_GENERAL1_SMALL',
-    Image='aws/codebuild/docker:17.09.0',
-    Type='LINUX_CONTAINER',
-    EnvironmentVariables=[
-        {'Name': 'AWS_DEFAULT_REGION', 'Value': Ref('regionparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'AWS_ACCOUNT_ID', 'Value': Ref('accountparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'IMAGE_REPO_NAME', 'Value': Ref('mldockerregistrynameparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'IMAGE_TAG', 'Value': 'latest', 'Type': 'PLAINTEXT'},
-        {'Name': 'CODE_COMMIT_REPO', 'Value': Ref('reponameparameter'), 'Type': 'PLAINTEXT'}
-    ]
-)
-
-source = Source(
-    Type='CODEPIPELINE'
-)
-
-code_build_project = t.add_resource(Project(
-    'build',
-    Artifacts=code_build_artifacts,
-    Environment=environment,
-    Name=Join('', [Ref('projectnameparameter'), 'build']),
-    ServiceRole=GetAtt("CodepipelineExecutionRole", "Arn"),
-    Source=source,
-))
-
-
-# The place where codepipeline stores the source that it downloads from codecommit when the pipeline kicks off
-artifactStore = ArtifactStore(Location=Ref('CodePipelineBucket'), Type='S3')
-
-# This is the role that is used by both codepipeline and codebuild to execute it's actions. I tried very hard to keep
-# the policy document to the minimum required access. Bascially the pipeline is allowed to execute the lambda function
-# that is used to send off docker images to training. It's allowed to manipulate the contents of the buckets used to
-# store the machine learning data and the artificats in the codepipeline bucket. It's allowed to use get the source code
-# from the specific code repo defined in the template. It's allowed to push docker images into the registry defined in
-# the cfn template and finally it's allowed to write logs into cloudwatch.
-CodepipelineExecutionRole = t.add_resource(Role(
-    "CodepipelineExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName="CodepipelineExecutionRole",
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Action": ["kms:Decrypt"],
-                "Resource": GetAtt('projectkey', "Arn"),
-                "Effect": "Allow"
-            },
-                {
-                    "Action": [
-                        "lambda:listfunctions"
-                    ],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
+# The stages of the pipeline, in the order they run. The actions of a stage run side by side, apart from actions with a
+# higher RunOrder, which wait for the lower ones in their stage. An action is one of
+#
+#   source    the CodeCommit checkout, which every other action reads
+#   build     the CodeBuild image build
+#   validate  data_validator.py, which checks the manifest and that every input channel has data
+#   train     sageDispatch; with "Jobs": ["wide"] it only dispatches those manifest variants
+#
+# Validation runs next to the build rather than after it, so commit to first job takes max(build, validate) instead of
+# their sum. A project config can bring its own Stages, or name its variants with TrainVariants (or point Manifest at
+# the project's manifest.json to take the names of its Jobs), which turns every train action into one per variant.
+# Each variant then shows up, fails and can be retried on its own, and the rest of the stage doesn't wait on it.
+PIPELINE_STAGES = [
+    {'Name': 'Source', 'Actions': [{'Name': 'Source', 'Type': 'source'}]},
+    {'Name': 'Build', 'Actions': [{'Name': 'Build', 'Type': 'build'}, {'Name': 'Validate', 'Type': 'validate'}]},
+    {'Name': 'Train', 'Actions': [{'Name': 'Train', 'Type': 'train'}]},
+]
+
+
+def build_template(stages=None):
+    stages = PIPELINE_STAGES if stages is None else stages
+    validating = any(action['Type'] == 'validate' for stage in stages for action in stage['Actions'])
+
+    # CFN Template
+    t = Template()
+    t.add_description("This template hydrates a machine learning pipeline.")
+
+
+    # The name of the ml project you're working on
+    project_name_parameter = t.add_parameter(Parameter(
+        'projectnameparameter',
+        Type='String',
+        Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='mlworkflow'
+    ))
+    region_parameter = t.add_parameter(Parameter(
+        'regionparameter',
+        Type='String',
+        Description='This is the region in which you are deploying this template.',
+        MinLength='1',
+        Default='us-west-2'
+    ))
+
+
+    # This is to ensure that buckets created by the cfn template are unique
+    account_parameter = t.add_parameter(Parameter(
+        'accountparameter',
+        Type='Number',
+        Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
+        MinValue='12'
+    ))
+
+    # buckets used to store machine learning dataset. Anything in here will be served up to the sagemaker containers
+    input_bucket_parameter = t.add_parameter(Parameter(
+        'inputbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that holds your machine learning training and testing datasets.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='inputbucket'
+    ))
+
+    output_bucket_parameter = t.add_parameter(Parameter(
+        'outputbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that will receive the output of your machine learning training model.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='outputbucket'
+    ))
+
+    # the name of the pipeline that gets created by this cfn template and the name of the bucket used for the pipeline
+    # the name of the artificats that  hold the codecommit code the pipeline downloads.
+    pipeline_name_parameter = t.add_parameter(Parameter(
+        'pipelinenameparameter',
+        Type='String',
+        Description='This is the name the pipeline that is going to move the model from the repo to training in sagemaker.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='pipeline'
+    ))
+
+    # the name of the codecommmit repo where machine learning code gets commited to
+    # The name of the codebuild project that creates the docker container
+
+    repo_name_parameter = t.add_parameter(Parameter(
+        'reponameparameter',
+        Type='String',
+        Description='This is the name of the code commit repo that will be watched to trigger the pipeline as the model is revised and commited.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='mlrepo'
+    ))
+
+    # the name of the ecr registory that contains the docker container built for submission to sagemaker
+    ml_docker_registry_name_parameter = t.add_parameter(Parameter(
+        'mldockerregistrynameparameter',
+        Type='String',
+        Description='This is the name of the ecr registry used to contain the docker image with your model code.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='mldockerrepo'
+    ))
+
+    # variables for the name of the lambda function that gets invovked to send the container to training.
+    lambda_function_bucket_parameter = t.add_parameter(Parameter(
+        'lambdafunctionbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that contains the lambda function used to send your model into SageMaker.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='lambdabucket'
+    ))
+
+    loglevelparameter = t.add_parameter(Parameter(
+        'loglevelparameter',
+        Type='String',
+        Description='This is the logging parameter used for the lambda function used to send your model into SageMaker',
+        MinLength='1',
+        AllowedValues=['DEBUG', 'INFO','WARNING', 'ERROR','CRITICAL'],
+        Default='WARNING'
+    ))
+
+    # Uploads to the input bucket start the pipeline once no new object has arrived for this long, or as soon as a _SUCCESS
+    # object is uploaded, so a dataset of many files starts one execution rather than one per file.
+    data_quiet_seconds_parameter = t.add_parameter(Parameter(
+        'dataquietsecondsparameter',
+        Type='Number',
+        Description='Seconds without new uploads to the input bucket before the pipeline is started for them.',
+        MinValue='0',
+        Default='300'
+    ))
+
+    # KMS key used to encrypted the input and output bucks that contain the data sets
+    projectkmskeyparameter = t.add_parameter(Parameter(
+        'projectkmskeyparameter',
+        Type='String',
+        Description='This kms key is used to encrypt both the input and output buckets.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default='kmskey'
+    ))
+
+    # How the docker build is cached between builds. LOCAL keeps docker layers and the source on the build host, which is
+    # fastest but only helps builds that land on a host that still has them; S3 keeps the cache paths the buildspec lists
+    # in the artifact bucket. Either way the buildspec also pulls CACHE_FROM_IMAGE and builds with --cache-from, so layers
+    # that didn't change come out of ECR even on a cold host.
+    build_cache_parameter = t.add_parameter(Parameter(
+        'buildcacheparameter',
+        Type='String',
+        Description='How CodeBuild caches the docker build between builds.',
+        AllowedValues=['LOCAL', 'S3', 'NONE'],
+        Default='LOCAL'
+    ))
+
+    build_compute_type_parameter = t.add_parameter(Parameter(
+        'buildcomputetypeparameter',
+        Type='String',
+        Description='The CodeBuild compute type the docker image is built on.',
+        AllowedValues=['BUILD_GENERAL1_SMALL', 'BUILD_GENERAL1_MEDIUM', 'BUILD_GENERAL1_LARGE', 'BUILD_GENERAL1_2XLARGE'],
+        Default='BUILD_GENERAL1_SMALL'
+    ))
+
+    t.add_condition('BuildCacheLocal', Equals(Ref('buildcacheparameter'), 'LOCAL'))
+    t.add_condition('BuildCacheS3', Equals(Ref('buildcacheparameter'), 'S3'))
+
+
+    t.add_metadata({
+        'AWS::CloudFormation::Interface': {
+            'ParameterGroups': [
                 {
-                    "Action": [
-                        "lambda:invokefunction",
-                        "lambda:listfunctions"
-                    ],
-                    "Resource": [GetAtt('sageDispatch', "Arn")],
-                    "Effect": "Allow"
+                    'Label': {'default': 'General project configuration'},
+                    'Parameters': ['accountparameter', 'regionparameter', 'projectnameparameter']
                 },
                 {
-                    "Action": [
-                        "s3:ListBucket",
-                        "s3:GetBucketPolicy",
-                        "s3:GetObjectAcl",
-                        "s3:PutObjectAcl",
-                        "s3:DeleteObject",
-                        "s3:GetObject",
-                        "s3:PutObject",
-                        "s3:PutObjectTagging"
-                    ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("OutputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
+                    'Label': {'default': 'Encryption'},
+                    'Parameters': ['projectkmskeyparameter']
                 },
                 {
-                    "Action": [
-                        "codecommit:CancelUploadArchive",
-                        "codecommit:GetBranch",
-                        "codecommit:GetCommit",
-                        "codecommit:GetUploadArchiveStatus",
-                        "codecommit:UploadArchive"
-                    ],
-                    "Resource": [GetAtt("Repository", "Arn")],
-                    "Effect": "Allow"
+                    'Label': {'default': 'Input and output s3 buckets for training, testing, and evaultion data.'},
+                    'Parameters': ['inputbucketparameter', 'outputbucketparameter', 'dataquietsecondsparameter']
                 },
                 {
-                    "Action": [
-                        "codebuild:BatchGetBuilds",
-                        "codebuild:StartBuild",
-                        "ecr:GetAuthorizationToken",
-                        "iam:PassRole"
-                ],
-                    "Resource": "*",
-                    "Effect": "Allow"
+                    'Label': {'default': 'CI/CD Pipeline information'},
+                    'Parameters': ['pipelinenameparameter', 'reponameparameter', 'mldockerregistrynameparameter']
                 },
                 {
-                    "Action": [
-                        "ecr:GetDownloadUrlForLayer",
-                        "ecr:BatchGetImage",
-                        "ecr:BatchCheckLayerAvailability",
-                        "ecr:PutImage",
-                        "ecr:InitiateLayerUpload",
-                        "ecr:UploadLayerPart",
-                        "ecr:CompleteLayerUpload"
-                ],
-                    "Resource": Join('', ['arn:aws:ecr:',  Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
-                                          Ref('mldockerregistrynameparameter')]),
-                    "Effect": "Allow"
+                    'Label': {'default': 'Docker build'},
+                    'Parameters': ['buildcomputetypeparameter', 'buildcacheparameter']
                 },
-                {
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents",
-                        "logs:DescribeLogStreams"
-                    ],
-                    "Resource": ["arn:aws:logs:*:*:*"],
-                    "Effect": "Allow"
+    {
+                    'Label': {'default': 'Lambda function information'},
+                    'Parameters': ['lambdafunctionbucketparameter', 'loglevelparameter']
                 }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["codepipeline.amazonaws.com", "codebuild.amazonaws.com"]
+            ],
+            'ParameterLabels': {
+                'accountparameter': {'default': 'Account ID'},
+                'regionparameter': {'default': 'Region'},
+                'projectnameparameter': {'default': 'Project name'},
+                'projectkmskeyparameter': {'default': 'KMS key name'},
+                'inputbucketparameter': {'default': 'Model input bucket name'},
+                'outputbucketparameter': {'default': 'Model output bucket name'},
+                'dataquietsecondsparameter': {'default': 'Quiet window before new input data starts the pipeline'},
+                'pipelinenameparameter': {'default': 'Name of the CodePipeline pipeline'},
+                'reponameparameter': {'default': 'Name of the CodeCommit repo'},
+                'mldockerregistrynameparameter': {'default': 'Name of the ECR registry'},
+                'buildcomputetypeparameter': {'default': 'CodeBuild compute type'},
+                'buildcacheparameter': {'default': 'Docker build cache (LOCAL, S3 or NONE)'},
+                'lambdafunctionbucketparameter': {'default': 'Name of the S3 bucket that contains the lambda function zip file called sageDispatch.zip.'},
+                'loglevelparameter': {'default': 'The Lambda logging level to use for this function. Default is set to Warning.'}
             }
-        }]
-    },
-))
-
-#These are the various states that have to be defined in the pipeline
-
-source_action_id = ActionTypeID(
-    Category='Source',
-    Owner='AWS',
-    Provider='CodeCommit',
-    Version='1'
-)
-
-build_action_id = ActionTypeID(
-    Category='Build',
-    Owner='AWS',
-    Provider='CodeBuild',
-    Version='1'
-)
-
-invoke_action_id = ActionTypeID(
-    Category='Invoke',
-    Owner='AWS',
-    Provider='Lambda',
-    Version='1'
-)
-
-source_action = Actions(
-    ActionTypeId=source_action_id,
-    ###
-    Configuration={
-        "PollForSourceChanges": "false",
-        "BranchName": "master",
-        "RepositoryName": Ref('reponameparameter')
-    },
-    InputArtifacts=[],
-    Name='Source',
-    RunOrder=1,
-    OutputArtifacts=[OutputArtifacts(Name='source_action_output')]
-)
-
-build_action = Actions(
-    ActionTypeId=build_action_id,
-    Configuration={
-        "ProjectName": Ref('build')
-    },
-    InputArtifacts=[InputArtifacts(Name='source_action_output')],
-    Name='Build',
-    RunOrder=1,
-    OutputArtifacts=[OutputArtifacts(Name='build_action_output')]
-)
-
-invoke_action = Actions(
-    ActionTypeId=invoke_action_id,
-    Configuration={
-        "FunctionName": Join("", [Ref("projectnameparameter"),'sageDispatch'])
-    },
-    InputArtifacts=[InputArtifacts(Name='source_action_output')],
-    Name='Train',
-    RunOrder=1,
-    OutputArtifacts=[]
-)
-
-source_stage = Stages(
-    Actions=[source_action],
-    Name='Source'
-)
-
-build_stage = Stages(
-    Actions=[build_action],
-    Name='Build'
-)
-
-invoke_action = Stages(
-    Actions=[invoke_action],
-    Name='Train'
-)
-
-pipeline = t.add_resource(Pipeline(
-    'pipeline',
-    RoleArn=GetAtt("CodepipelineExecutionRole", "Arn"),
-    ArtifactStore=artifactStore,
-    Stages=[source_stage, build_stage, invoke_action]))
-
-# In order for the pipeline to be triggered by a code commit what's required is a cloudwatch event rule. This rule is
-# configured so that whenever a commmit event comes over the cloudwatch event bus for the specific code commit repo it
-# then executtes a startpipelineexecution call to the piepeline. Notice after this pattern that there is also a role
-# that the rule assumes.
-cw_event_pattern = {
-    "source": [
-        "aws.codecommit"
-    ],
-    "resources": [
-        GetAtt("Repository", "Arn")
-    ],
-    "detail-type": [
-        "CodeCommit Repository State Change"
-    ],
-    "detail": {
-        "event": [
-            "referenceCreated",
-            "referenceUpdated"
-        ],
-        "referenceType": [
-            "branch"
-        ],
-        "referenceName": [
-            "master"
+        }
+    })
+
+    # Add the project's kms key to the cfn template
+    project_key = t.add_resource(Key('projectkey',
+                                     Description='Key used for ML pipeline',
+                                     Enabled=True,
+                                     EnableKeyRotation=True,
+                                     KeyPolicy={
+                                         "Version": "2012-10-17",
+                                         "Id": 'mlkey',
+                                         "Statement": [
+                                             {
+                                                 "Sid": "Enable IAM User Permissions",
+                                                 "Effect": "Allow",
+                                                 "Principal": {
+                                                     "AWS": Join(":", ["arn:aws:iam:", Ref("AWS::AccountId"), "root"])
+                                                    },
+                                                 "Action": "kms:*",
+                                                 "Resource": "*"
+                                             }]
+                                     }
+                                     ))
+
+    #Encryption configs for input and output buckets
+    bucket_encryption_config = ServerSideEncryptionByDefault(
+        KMSMasterKeyID=GetAtt('projectkey', "Arn"),
+        SSEAlgorithm='aws:kms')
+
+    bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=bucket_encryption_config)
+    bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[bucket_encryption_rule])
+
+    #Encryption configs for codepipeline bucket
+    cp_bucket_encryption_config = ServerSideEncryptionByDefault(
+        SSEAlgorithm='AES256')
+
+    cp_bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=cp_bucket_encryption_config)
+    cp_bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[cp_bucket_encryption_rule])
+
+
+    input_bucket = t.add_resource(Bucket(
+        'InputBucket',
+        AccessControl='Private',
+        BucketName=Join("", [Ref("accountparameter"), Ref("inputbucketparameter")]),
+        #BucketEncryption=cp_bucket_encryption,
+        VersioningConfiguration=VersioningConfiguration(Status='Enabled'),
+        NotificationConfiguration=NotificationConfiguration(
+            EventBridgeConfiguration=EventBridgeConfiguration(EventBridgeEnabled=True))
+    ))
+
+    output_bucket = t.add_resource(Bucket(
+        'OutputBucket',
+        AccessControl='Private',
+        BucketName=Join("", [Ref("accountparameter"), Ref("outputbucketparameter")])
+        #BucketEncryption=cp_bucket_encryption,
+        #DependsOn='CodePipelineBucket'
+    ))
+
+    codepipeline_artifact_store_bucket = t.add_resource(Bucket(
+        'CodePipelineBucket',
+        AccessControl='Private',
+        BucketName=Join('', [Ref('accountparameter'), Ref('projectnameparameter'), 'artifactstore']),
+        BucketEncryption=bucket_encryption
+
+    ))
+
+    # Add ecr repo to the cfn template
+    ml_docker_repo = t.add_resource(Docker_Repo('mlrepo', RepositoryName=Ref('mldockerregistrynameparameter')))
+
+    # Add codecommit repo
+    repo = t.add_resource(Repository('Repository', RepositoryDescription='ML repo', RepositoryName=Ref('reponameparameter')))
+
+
+    # Start to build out the codeBuild portion of the solution. This part of the pipeline relies on dockerfile being present
+    # in the codecommit repo that the pipeline passes onto it. The build details should also be contained in a buildspec.yml
+    # file that is also located in the same repo. The buildspec file will use the docker file to create a container based on
+    # the dockerfile and then tag it with the commit id that triggered the pipeline. Once the build is complete it will push
+    # it to ecr. With image_hash.py in the repo the buildspec can skip the build altogether when the Dockerfile and the
+    # training sources are unchanged and just add the commit tag to the image that was built from them (see the README).
+    code_build_artifacts = Artifacts(Type='CODEPIPELINE')
+
+    environment = Environment(
+        ComputeType=Ref('buildcomputetypeparameter'),
+        Image='aws/codebuild/docker:17.09.0',
+        Type='LINUX_CONTAINER',
+        # The docker daemon, and with it the local layer cache, needs a privileged build container.
+        PrivilegedMode=True,
+        EnvironmentVariables=[
+            {'Name': 'AWS_DEFAULT_REGION', 'Value': Ref('regionparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'AWS_ACCOUNT_ID', 'Value': Ref('accountparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'IMAGE_REPO_NAME', 'Value': Ref('mldockerregistrynameparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'IMAGE_TAG', 'Value': 'latest', 'Type': 'PLAINTEXT'},
+            {'Name': 'CODE_COMMIT_REPO', 'Value': Ref('reponameparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'CACHE_FROM_IMAGE', 'Type': 'PLAINTEXT',
+             'Value': Join('', [Ref('accountparameter'), ".dkr.ecr.", Ref('regionparameter'), ".amazonaws.com/",
+                                Ref('mldockerregistrynameparameter'), ":latest"])}
         ]
-    }
-}
+    )
 
-# Role that allows the event rule to execute the start of the pipeline against the specific pipeline created in this cfn
-CloudWatchEventExecutionRole = t.add_resource(Role(
-    "CloudWatchEventExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName='pipelineTargetRulePolicy',
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Action": "codepipeline:StartPipelineExecution",
-                "Resource": Join('', ['arn:aws:codepipeline:',  Ref('regionparameter'), ':',  Ref('accountparameter'), ':',  Ref('pipeline')]),
-                "Effect": "Allow"
-            }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["events.amazonaws.com"]
-            }
-        }]
-    },
-))
-
-cw_rule_target = Target(
-    Arn=Join('', ["arn:aws:codepipeline:", Ref('regionparameter'), ':', Ref('accountparameter'), ':', Ref('pipeline')]),
-    Id='mlTargert1',
-    RoleArn=GetAtt("CloudWatchEventExecutionRole", "Arn")
-)
-
-pipeline_cw_rule = t.add_resource(Rule(
-    'mlpipelinerule',
-    Description='Triggers codepipeline',
-    EventPattern=cw_event_pattern,
-    State='ENABLED',
-    Targets=[cw_rule_target]
-
-))
-
-# This role allows sagemaker to do things like use the kms key that was used to encrypt the contents of the input and
-# output buckets as well as pull docker container images from the ecr repo.
-SagemakerExecutionRole = t.add_resource(Role(
-    "SagemakerExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName="SagemakerExecutionRole",
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Action": [
-                        "kms:Decrypt",
-                        "kms:GenerateDataKey"
-                    ],
+    build_cache = If('BuildCacheLocal',
+                     ProjectCache(Type='LOCAL', Modes=['LOCAL_DOCKER_LAYER_CACHE', 'LOCAL_SOURCE_CACHE']),
+                     If('BuildCacheS3',
+                        ProjectCache(Type='S3', Location=Join('', [Ref('CodePipelineBucket'), '/build-cache'])),
+                        ProjectCache(Type='NO_CACHE')))
+
+    source = Source(
+        Type='CODEPIPELINE'
+    )
+
+    code_build_project = t.add_resource(Project(
+        'build',
+        Artifacts=code_build_artifacts,
+        Cache=build_cache,
+        Environment=environment,
+        Name=Join('', [Ref('projectnameparameter'), 'build']),
+        ServiceRole=GetAtt("CodepipelineExecutionRole", "Arn"),
+        Source=source,
+    ))
+
+
+    # The place where codepipeline stores the source that it downloads from codecommit when the pipeline kicks off
+    artifactStore = ArtifactStore(Location=Ref('CodePipelineBucket'), Type='S3')
+
+    # This is the role that is used by both codepipeline and codebuild to execute it's actions. I tried very hard to keep
+    # the policy document to the minimum required access. Bascially the pipeline is allowed to execute the lambda function
+    # that is used to send off docker images to training. It's allowed to manipulate the contents of the buckets used to
+    # store the machine learning data and the artificats in the codepipeline bucket. It's allowed to use get the source code
+    # from the specific code repo defined in the template. It's allowed to push docker images into the registry defined in
+    # the cfn template and finally it's allowed to write logs into cloudwatch.
+    CodepipelineExecutionRole = t.add_resource(Role(
+        "CodepipelineExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName="CodepipelineExecutionRole",
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Action": ["kms:Decrypt"],
                     "Resource": GetAtt('projectkey', "Arn"),
                     "Effect": "Allow"
                 },
-                {
-                    "Action": [
-                        "s3:GetObject",
-                        "s3:PutObject",
-                        "s3:DeleteObject"
+                    {
+                        "Action": [
+                            "lambda:listfunctions"
+                        ],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "lambda:invokefunction",
+                            "lambda:listfunctions"
+                        ],
+                        "Resource": [GetAtt('sageDispatch', "Arn")] + (
+                            [GetAtt('dataValidator', "Arn")] if validating else []),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "s3:ListBucket",
+                            "s3:GetBucketPolicy",
+                            "s3:GetObjectAcl",
+                            "s3:PutObjectAcl",
+                            "s3:DeleteObject",
+                            "s3:GetObject",
+                            "s3:PutObject",
+                            "s3:PutObjectTagging"
+                        ],
+                        "Resource": [
+                            Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
+                            Join('', [GetAtt("OutputBucket", "Arn"), "/*"]),
+                            Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"])
+                        ],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "codecommit:CancelUploadArchive",
+                            "codecommit:GetBranch",
+                            "codecommit:GetCommit",
+                            "codecommit:GetUploadArchiveStatus",
+                            "codecommit:UploadArchive"
+                        ],
+                        "Resource": [GetAtt("Repository", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "codebuild:BatchGetBuilds",
+                            "codebuild:StartBuild",
+                            "ecr:GetAuthorizationToken",
+                            "iam:PassRole"
                     ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("OutputBucket", "Arn"), "/*"])
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "ecr:GetDownloadUrlForLayer",
+                            "ecr:BatchGetImage",
+                            "ecr:BatchCheckLayerAvailability",
+                            "ecr:PutImage",
+                            "ecr:InitiateLayerUpload",
+                            "ecr:UploadLayerPart",
+                            "ecr:CompleteLayerUpload"
                     ],
-                    "Effect": "Allow"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3:CreateBucket",
-                        "s3:GetBucketLocation",
-                        "s3:ListBucket",
-                        "s3:ListAllMyBuckets"
-                    ],
-                    "Resource": "*"
+                        "Resource": Join('', ['arn:aws:ecr:',  Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                              Ref('mldockerregistrynameparameter')]),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "logs:CreateLogGroup",
+                            "logs:CreateLogStream",
+                            "logs:PutLogEvents",
+                            "logs:DescribeLogStreams"
+                        ],
+                        "Resource": ["arn:aws:logs:*:*:*"],
+                        "Effect": "Allow"
+                    }
+                ]
+            })],
+        AssumeRolePolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Action": ["sts:AssumeRole"],
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": ["codepipeline.amazonaws.com", "codebuild.amazonaws.com"]
+                }
+            }]
+        },
+    ))
+
+    #These are the various states that have to be defined in the pipeline
+
+    source_action_id = ActionTypeID(
+        Category='Source',
+        Owner='AWS',
+        Provider='CodeCommit',
+        Version='1'
+    )
+
+    build_action_id = ActionTypeID(
+        Category='Build',
+        Owner='AWS',
+        Provider='CodeBuild',
+        Version='1'
+    )
+
+    invoke_action_id = ActionTypeID(
+        Category='Invoke',
+        Owner='AWS',
+        Provider='Lambda',
+        Version='1'
+    )
+
+    # One action per entry of the stage graph, see PIPELINE_STAGES.
+    def pipeline_action(action):
+        if action['Type'] == 'source':
+            return Actions(
+                ActionTypeId=source_action_id,
+                Configuration={
+                    "PollForSourceChanges": "false",
+                    "BranchName": "master",
+                    "RepositoryName": Ref('reponameparameter')
                 },
-                {
-                    "Action": [
-                        "ecr:GetAuthorizationToken",
-                        "ecr:GetDownloadUrlForLayer",
-                        "ecr:BatchGetImage",
-                        "ecr:BatchCheckLayerAvailability"
-                    ],
-                    "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
-                                          Ref('mldockerregistrynameparameter')]),
-                    "Effect": "Allow"
+                InputArtifacts=[],
+                Name=action['Name'],
+                RunOrder=action.get('RunOrder', 1),
+                OutputArtifacts=[OutputArtifacts(Name='source_action_output')]
+            )
+        if action['Type'] == 'build':
+            return Actions(
+                ActionTypeId=build_action_id,
+                Configuration={
+                    "ProjectName": Ref('build')
                 },
-                {
-                    "Action": [
-                        "ecr:GetAuthorizationToken"
-                    ],
-                    "Resource": "*",
+                InputArtifacts=[InputArtifacts(Name='source_action_output')],
+                Name=action['Name'],
+                RunOrder=action.get('RunOrder', 1),
+                OutputArtifacts=[OutputArtifacts(Name='build_action_output')]
+            )
+        if action['Type'] in ('validate', 'train'):
+            configuration = {
+                "FunctionName": Join("", [Ref("projectnameparameter"),
+                                          'dataValidator' if action['Type'] == 'validate' else 'sageDispatch'])
+            }
+            if 'Jobs' in action:
+                configuration['UserParameters'] = json.dumps({'Jobs': action['Jobs']}, separators=(',', ':'))
+            return Actions(
+                ActionTypeId=invoke_action_id,
+                Configuration=configuration,
+                InputArtifacts=[InputArtifacts(Name='source_action_output')],
+                Name=action['Name'],
+                RunOrder=action.get('RunOrder', 1),
+                OutputArtifacts=[]
+            )
+        raise ValueError('unknown pipeline action type %r in %s' % (action['Type'], action['Name']))
+
+    pipeline = t.add_resource(Pipeline(
+        'pipeline',
+        RoleArn=GetAtt("CodepipelineExecutionRole", "Arn"),
+        ArtifactStore=artifactStore,
+        Stages=[Stages(Actions=[pipeline_action(action) for action in stage['Actions']], Name=stage['Name'])
+                for stage in stages]))
+
+    # In order for the pipeline to be triggered by a code commit what's required is a cloudwatch event rule. This rule is
+    # configured so that whenever a commmit event comes over the cloudwatch event bus for the specific code commit repo it
+    # invokes the commitTrigger lambda (sns_sage_dispatch.py), which diffs the push and only starts the pipeline when the
+    # push changed a path the manifest's TriggerPaths cover. Notice after this pattern that there is also a role that the
+    # lambda assumes.
+    cw_event_pattern = {
+        "source": [
+            "aws.codecommit"
+        ],
+        "resources": [
+            GetAtt("Repository", "Arn")
+        ],
+        "detail-type": [
+            "CodeCommit Repository State Change"
+        ],
+        "detail": {
+            "event": [
+                "referenceCreated",
+                "referenceUpdated"
+            ],
+            "referenceType": [
+                "branch"
+            ],
+            "referenceName": [
+                "master"
+            ]
+        }
+    }
+
+    # Role that allows the trigger lambda to diff pushes to the repo and start the pipeline created in this cfn
+    TriggerExecutionRole = t.add_resource(Role(
+        "TriggerExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName='pipelineTriggerPolicy',
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Action": ["codepipeline:StartPipelineExecution", "codepipeline:ListPipelineExecutions"],
+                    "Resource": Join('', ['arn:aws:codepipeline:',  Ref('regionparameter'), ':',  Ref('accountparameter'), ':',  Ref('pipeline')]),
                     "Effect": "Allow"
                 },
-{
-                    "Action": [
-                        "cloudwatch:PutMetricData"
-                    ],
-                    "Resource": "*",
+                    {
+                        "Action": [
+                            "codecommit:GetDifferences",
+                            "codecommit:GetFile"
+                        ],
+                        "Resource": [GetAtt("Repository", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "logs:CreateLogGroup",
+                            "logs:CreateLogStream",
+                            "logs:PutLogEvents"
+                        ],
+                        "Resource": ["arn:aws:logs:*:*:*"],
+                        "Effect": "Allow"
+                    }
+                ]
+            })],
+        AssumeRolePolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Action": ["sts:AssumeRole"],
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": ["lambda.amazonaws.com"]
+                }
+            }]
+        },
+    ))
+
+    trigger_func = t.add_resource(Function(
+        'commitTrigger',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName=Join("", [Ref("projectnameparameter"), 'commitTrigger']),
+        Handler="sns_sage_dispatch.handler",
+        Role=GetAtt("TriggerExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=Lambda_Environment(Variables={
+            'PIPELINE_NAME': Ref('pipeline'),
+            'BRANCH': 'master',
+            'LOG_LEVEL': Ref('loglevelparameter')
+        }),
+        Timeout=60
+    ))
+
+    cw_rule_target = Target(
+        Arn=GetAtt('commitTrigger', 'Arn'),
+        Id='mlTargert1'
+    )
+
+    pipeline_cw_rule = t.add_resource(Rule(
+        'mlpipelinerule',
+        Description='Triggers codepipeline',
+        EventPattern=cw_event_pattern,
+        State='ENABLED',
+        Targets=[cw_rule_target]
+
+    ))
+
+    t.add_resource(Permission(
+        'commitTriggerPermission',
+        Action='lambda:InvokeFunction',
+        FunctionName=GetAtt('commitTrigger', 'Arn'),
+        Principal='events.amazonaws.com',
+        SourceArn=GetAtt('mlpipelinerule', 'Arn')
+    ))
+
+    # New objects in the input bucket go to the dataWatcher lambda (model_data_watcher.py) over the event bus. It records
+    # them in the output bucket and starts the pipeline once for the whole upload; the schedule is what notices that the
+    # uploads have stopped.
+    DataWatcherExecutionRole = t.add_resource(Role(
+        "DataWatcherExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName='dataWatcherPolicy',
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Action": ["codepipeline:StartPipelineExecution", "codepipeline:ListPipelineExecutions"],
+                    "Resource": Join('', ['arn:aws:codepipeline:',  Ref('regionparameter'), ':',  Ref('accountparameter'), ':',  Ref('pipeline')]),
                     "Effect": "Allow"
                 },
-                {
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:DescribeLogStreams",
-                        "logs:GetLogEvents",
-                        "logs:PutLogEvents"
-                    ],
-                    "Resource": ["arn:aws:logs:*:*:*"],
-                    "Effect": "Allow"
+                    {
+                        "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
+                        "Resource": [Join('', [GetAtt("OutputBucket", "Arn"), "/data-watch/*"])],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:ListBucket"],
+                        "Resource": [GetAtt("OutputBucket", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "logs:CreateLogGroup",
+                            "logs:CreateLogStream",
+                            "logs:PutLogEvents"
+                        ],
+                        "Resource": ["arn:aws:logs:*:*:*"],
+                        "Effect": "Allow"
+                    }
+                ]
+            })],
+        AssumeRolePolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Action": ["sts:AssumeRole"],
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": ["lambda.amazonaws.com"]
+                }
+            }]
+        },
+    ))
+
+    watcher_func = t.add_resource(Function(
+        'dataWatcher',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName=Join("", [Ref("projectnameparameter"), 'dataWatcher']),
+        Handler="model_data_watcher.handler",
+        Role=GetAtt("DataWatcherExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=Lambda_Environment(Variables={
+            'PIPELINE_NAME': Ref('pipeline'),
+            'WATCH_STATE': Join('', ['s3://', Ref('OutputBucket'), '/data-watch/']),
+            'QUIET_SECONDS': Ref('dataquietsecondsparameter'),
+            'LOG_LEVEL': Ref('loglevelparameter')
+        }),
+        Timeout=60
+    ))
+
+    input_data_rule = t.add_resource(Rule(
+        'inputdatarule',
+        Description='Sends new input data objects to the data watcher',
+        EventPattern={
+            "source": ["aws.s3"],
+            "detail-type": ["Object Created"],
+            "detail": {
+                "bucket": {
+                    "name": [Ref('InputBucket')]
                 }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["sagemaker.amazonaws.com"]
             }
-        }]
-    },
-))
-
-# This is the role for the lambda function that is used to setup the sagemaker job. It needs permissions to get the
-# commit id so that it can setup a training job with a specific docker container, get the artificats of the pipeline so
-# that it can read the manifest file which defines certain parts of the job information, send a job to sagemaker, and
-# finally to signal back to the pipeline success or failure.
-LambdaExecutionRole = t.add_resource(Role(
-    "LambdaExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName='sageDispatch',
-        PolicyDocument={
+        },
+        State='ENABLED',
+        Targets=[Target(Arn=GetAtt('dataWatcher', 'Arn'), Id='dataWatcher')]
+    ))
+
+    input_data_flush_rule = t.add_resource(Rule(
+        'inputdataflushrule',
+        Description='Starts the pipeline for input data uploads that have gone quiet',
+        ScheduleExpression='rate(1 minute)',
+        State='ENABLED',
+        Targets=[Target(Arn=GetAtt('dataWatcher', 'Arn'), Id='dataWatcher')]
+    ))
+
+    for rule in ('inputdatarule', 'inputdataflushrule'):
+        t.add_resource(Permission(
+            rule + 'Permission',
+            Action='lambda:InvokeFunction',
+            FunctionName=GetAtt('dataWatcher', 'Arn'),
+            Principal='events.amazonaws.com',
+            SourceArn=GetAtt(rule, 'Arn')
+        ))
+
+    # This role allows sagemaker to do things like use the kms key that was used to encrypt the contents of the input and
+    # output buckets as well as pull docker container images from the ecr repo. Spot and checkpointed jobs sync their
+    # checkpoints with the output bucket's checkpoints/ prefix, which the output bucket statements below cover, and
+    # big checkpoints go up as multipart uploads that get aborted when a spot instance is taken away mid upload.
+    SagemakerExecutionRole = t.add_resource(Role(
+        "SagemakerExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName="SagemakerExecutionRole",
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Action": [
+                            "kms:Decrypt",
+                            "kms:GenerateDataKey"
+                        ],
+                        "Resource": GetAtt('projectkey', "Arn"),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "s3:GetObject",
+                            "s3:PutObject",
+                            "s3:DeleteObject"
+                        ],
+                        "Resource": [
+                            Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
+                            Join('', [GetAtt("OutputBucket", "Arn"), "/*"])
+                        ],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "s3:AbortMultipartUpload",
+                            "s3:ListMultipartUploadParts"
+                        ],
+                        "Resource": [Join('', [GetAtt("OutputBucket", "Arn"), "/checkpoints/*"])],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Effect": "Allow",
+                        "Action": [
+                            "s3:CreateBucket",
+                            "s3:GetBucketLocation",
+                            "s3:ListBucket",
+                            "s3:ListAllMyBuckets"
+                        ],
+                        "Resource": "*"
+                    },
+                    {
+                        "Action": [
+                            "ecr:GetAuthorizationToken",
+                            "ecr:GetDownloadUrlForLayer",
+                            "ecr:BatchGetImage",
+                            "ecr:BatchCheckLayerAvailability"
+                        ],
+                        "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                              Ref('mldockerregistrynameparameter')]),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "ecr:GetAuthorizationToken"
+                        ],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+    {
+                        "Action": [
+                            "cloudwatch:PutMetricData"
+                        ],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "logs:CreateLogGroup",
+                            "logs:CreateLogStream",
+                            "logs:DescribeLogStreams",
+                            "logs:GetLogEvents",
+                            "logs:PutLogEvents"
+                        ],
+                        "Resource": ["arn:aws:logs:*:*:*"],
+                        "Effect": "Allow"
+                    }
+                ]
+            })],
+        AssumeRolePolicyDocument={
             "Version": "2012-10-17",
             "Statement": [{
-                "Action": ["logs:*"],
-                "Resource": "arn:aws:logs:*:*:*",
-                "Effect": "Allow"
-            },
-                {
-                    "Action": ["kms:Decrypt"],
-                    "Resource": GetAtt('projectkey', "Arn"),
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": ["codepipeline:PutJobFailureResult",
-                               "codepipeline:PutJobSuccessResult"],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "codecommit:GetBranch"
-                    ],
-                    "Resource": [GetAtt("Repository", "Arn")],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": ["s3:GetObject"],
-                    "Resource": [
-                        Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "s3:GetObjectVersion"
-                    ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": ["sagemaker:CreateTrainingJob"],
-                    "Resource": "*",
+                "Action": ["sts:AssumeRole"],
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": ["sagemaker.amazonaws.com"]
+                }
+            }]
+        },
+    ))
+
+    # This is the role for the lambda function that is used to setup the sagemaker job. It needs permissions to get the
+    # commit id so that it can setup a training job with a specific docker container, get the artificats of the pipeline so
+    # that it can read the manifest file which defines certain parts of the job information, send a job to sagemaker, and
+    # finally to signal back to the pipeline success or failure.
+    LambdaExecutionRole = t.add_resource(Role(
+        "LambdaExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName='sageDispatch',
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Action": ["logs:*"],
+                    "Resource": "arn:aws:logs:*:*:*",
                     "Effect": "Allow"
                 },
-                {
-                    "Action": ["iam:PassRole"],
-                    "Resource": "*",
-                    "Effect": "Allow"
+                    {
+                        "Action": ["kms:Decrypt"],
+                        "Resource": GetAtt('projectkey', "Arn"),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["codepipeline:PutJobFailureResult",
+                                   "codepipeline:PutJobSuccessResult"],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "codecommit:GetBranch",
+                            "codecommit:GetCommit"
+                        ],
+                        "Resource": [GetAtt("Repository", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:GetObject"],
+                        "Resource": [
+                            Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"]),
+                            Join('', [GetAtt("InputBucket", "Arn"), "/*"])
+                        ],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": [
+                            "s3:GetObjectVersion"
+                        ],
+                        "Resource": [
+                            Join('', [GetAtt("InputBucket", "Arn"), "/*"])
+                        ],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:ListBucketVersions"],
+                        "Resource": [GetAtt("InputBucket", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:GetObject", "s3:PutObject"],
+                        "Resource": [Join('', [GetAtt("OutputBucket", "Arn"), "/job-index/*"])],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:PutObject"],
+                        "Resource": [Join('', [GetAtt("OutputBucket", "Arn"), "/data-snapshots/*"])],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["s3:ListBucket"],
+                        "Resource": [GetAtt("OutputBucket", "Arn"), GetAtt("InputBucket", "Arn")],
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["ecr:DescribeImages"],
+                        "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                              Ref('mldockerregistrynameparameter')]),
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["sagemaker:CreateTrainingJob",
+                                   "sagemaker:CreateHyperParameterTuningJob",
+                                   "sagemaker:DescribeTrainingJob",
+                                   "sagemaker:DescribeHyperParameterTuningJob",
+                                   "sagemaker:AddTags",
+                                   "sagemaker:Search"],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    },
+                    {
+                        "Action": ["iam:PassRole"],
+                        "Resource": "*",
+                        "Effect": "Allow"
+                    }
+                ]
+            })],
+        AssumeRolePolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Action": ["sts:AssumeRole"],
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": ["lambda.amazonaws.com"]
                 }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["lambda.amazonaws.com"]
-            }
-        }]
-    },
-))
-
-# I used these environment variables so that the lambda code remains static while these fiddly bits that get setup
-# for the project can just be injected in.
-lambda_env = Lambda_Environment(Variables={
-    'APP_BUNDLE': 'source_action_output',
-    'CODE_COMMIT_REPO': Ref('reponameparameter'),
-    'TRAINING_IMAGE': Join('',[Ref('accountparameter'), ".dkr.ecr.", Ref('regionparameter'), ".amazonaws.com/", Ref('mldockerregistrynameparameter')]),
-    'SAGEMAKER_ROLE_ARN': GetAtt("SagemakerExecutionRole", "Arn"),
-    'INPUT_BUCKET': Join('', ['s3://', Ref('InputBucket'), '/']),
-    'BUCKET_KEY_ARN': GetAtt('projectkey', "Arn"),
-    'OUTPUT_BUCKET': Join('', ['s3://', Ref('OutputBucket'), '/output/']),
-    'LOG_LEVEL': Ref('loglevelparameter')
+            }]
+        },
+    ))
+
+    # I used these environment variables so that the lambda code remains static while these fiddly bits that get setup
+    # for the project can just be injected in.
+    lambda_env = Lambda_Environment(Variables={
+        'APP_BUNDLE': 'source_action_output',
+        'CODE_COMMIT_REPO': Ref('reponameparameter'),
+        'TRAINING_IMAGE': Join('',[Ref('accountparameter'), ".dkr.ecr.", Ref('regionparameter'), ".amazonaws.com/", Ref('mldockerregistrynameparameter')]),
+        'SAGEMAKER_ROLE_ARN': GetAtt("SagemakerExecutionRole", "Arn"),
+        'INPUT_BUCKET': Join('', ['s3://', Ref('InputBucket'), '/']),
+        'BUCKET_KEY_ARN': GetAtt('projectkey', "Arn"),
+        'OUTPUT_BUCKET': Join('', ['s3://', Ref('OutputBucket'), '/output/']),
+        'JOB_INDEX': Join('', ['s3://', Ref('OutputBucket'), '/job-index/']),
+        'DATA_SNAPSHOTS': Join('', ['s3://', Ref('OutputBucket'), '/data-snapshots/']),
+        'CHECKPOINTS': Join('', ['s3://', Ref('OutputBucket'), '/checkpoints/']),
+        'LOG_LEVEL': Ref('loglevelparameter')
+    }
+    )
+
+    func = t.add_resource(Function(
+        'sageDispatch',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName=Join("", [Ref("projectnameparameter"),'sageDispatch']),
+        Handler="sageDispatch.lambda_handler",
+        Role=GetAtt("LambdaExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=lambda_env,
+        Timeout=300
+    ))
+
+    # The data validation action (data_validator.py) ships in the same bundle and reads the manifest and the input
+    # bucket the way sageDispatch does, so it shares its role and environment. It only exists when the stage graph has
+    # a validate action.
+    if validating:
+        validator_func = t.add_resource(Function(
+            'dataValidator',
+            Code=Code(
+                S3Bucket=Ref('lambdafunctionbucketparameter'),
+                S3Key='sageDispatch.zip'
+            ),
+            FunctionName=Join("", [Ref("projectnameparameter"), 'dataValidator']),
+            Handler="data_validator.handler",
+            Role=GetAtt("LambdaExecutionRole", "Arn"),
+            Runtime="python3.12",
+            Environment=lambda_env,
+            Timeout=120
+        ))
+
+    # t.add_output([
+    #     Output(
+    #         "inputbucketoutput",
+    #         Description="Bucket where you must upload your training and test data",
+    #         Value=GetAtt("InputBucket", "DomainName"),
+    #     ),
+    #     Output(
+    #         "outputbucketoutput",
+    #         Description="Bucket where the output of your model is persisted",
+    #         Value=GetAtt("OutputBucket", "DomainName"),
+    #     ),
+    #     Output(
+    #         "reponameoutput",
+    #         Description="Repo to which you need to commit your model and its supporting files",
+    #         Value=GetAtt("Repository", "Name"),
+    #     ),
+    #     Output(
+    #         "repocloneurloutput",
+    #         Description="Public DNSName of the newly created EC2 instance",
+    #         Value=GetAtt("Repository", "CloneUrlHttp"),
+    #     ),
+    # ])
+    return t
+
+
+# Every resource in the template refers to the project only through the parameters, so the template is built once per
+# process and a project's template is that one with its own parameter defaults filled in. A project config looks like
+#
+#   {"Output": "teams/census.json", "Parameters": {"projectnameparameter": "census", "accountparameter": "123456789012"}}
+#
+# and a config file holds a list of them. Output defaults to <projectnameparameter>.json. Configs can also change the
+# stage graph (see PIPELINE_STAGES), and a template is built for each distinct graph.
+#
+# Templates are written minified. CloudFormation takes at most INLINE_TEMPLATE_LIMIT bytes of template inline, so one
+# that is still bigger than that is split into nested stacks, one per STACK_LAYERS entry, written next to it as
+# <name>-<layer>.json. Those have to be uploaded to <templatebucketparameter>/<projectnameparameter>/ before the
+# parent stack is created or updated; an update then only touches the nested stacks whose templates changed.
+_base_templates = {}
+_base_text = {}
+PARAMETERS_PLACEHOLDER = '"@@Parameters@@"'
+INLINE_TEMPLATE_LIMIT = 51200
+
+# Resources go into the first layer their type belongs to (anything unlisted goes last) and are then pushed down into
+# later layers until nothing refers to a resource in a layer after its own, so the nested stacks only ever depend on
+# the ones before them. Roles that name the pipeline, for example, end up in cicd with it.
+STACK_LAYERS = ['storage', 'iam', 'dispatch', 'cicd']
+LAYER_TYPES = {
+    'AWS::KMS::Key': 'storage',
+    'AWS::S3::Bucket': 'storage',
+    'AWS::ECR::Repository': 'storage',
+    'AWS::CodeCommit::Repository': 'storage',
+    'AWS::IAM::Role': 'iam',
+    'AWS::Lambda::Function': 'dispatch',
+    'AWS::Lambda::Permission': 'dispatch',
 }
-)
-
-func = t.add_resource(Function(
-    'sageDispatch',
-    Code=Code(
-        S3Bucket=Ref('lambdafunctionbucketparameter'),
-        S3Key='sageDispatch.zip'
-    ),
-    FunctionName=Join("", [Ref("projectnameparameter"),'sageDispatch']),
-    Handler="sageDispatch.lambda_handler",
-    Role=GetAtt("LambdaExecutionRole", "Arn"),
-    Runtime="python2.7",
-    Environment=lambda_env,
-    Timeout=300
-))
-
-# t.add_output([
-#     Output(
-#         "inputbucketoutput",
-#         Description="Bucket where you must upload your training and test data",
-#         Value=GetAtt("InputBucket", "DomainName"),
-#     ),
-#     Output(
-#         "outputbucketoutput",
-#         Description="Bucket where the output of your model is persisted",
-#         Value=GetAtt("OutputBucket", "DomainName"),
-#     ),
-#     Output(
-#         "reponameoutput",
-#         Description="Repo to which you need to commit your model and its supporting files",
-#         Value=GetAtt("Repository", "Name"),
-#     ),
-#     Output(
-#         "repocloneurloutput",
-#         Description="Public DNSName of the newly created EC2 instance",
-#         Value=GetAtt("Repository", "CloneUrlHttp"),
-#     ),
-# ])
-
-# This prints out the CFN template. You could of course write this to a file but I is lazy. Oh and don't print to yaml.
-# There's either some bug with tropophere or with CF that causes templates to fail legacy parsing when submitted to CF
-# in yaml format. It's certainly easier to look at but I got tired to troubleshooting.
-text_file = open("pipeline.json", "w")
-text_file.write(t.to_json())
-text_file.close()
-print('Send to file')
+
+
+def pipeline_stages(config):
+    if 'Stages' in config:
+        return config['Stages']
+    variants = config.get('TrainVariants')
+    if variants is None and 'Manifest' in config:
+        with open(config['Manifest']) as manifest_file:
+            variants = [job['Name'] for job in json.load(manifest_file).get('Jobs', [])]
+    if not variants:
+        return PIPELINE_STAGES
+    stages = []
+    for stage in PIPELINE_STAGES:
+        actions = []
+        for action in stage['Actions']:
+            if action['Type'] != 'train':
+                actions.append(action)
+                continue
+            # Action names only allow alphanumerics and . @ - _
+            actions.extend(dict(action, Name='%s-%s' % (action['Name'], re.sub('[^A-Za-z0-9.@_-]', '-', variant)),
+                                Jobs=[variant]) for variant in variants)
+        stages.append(dict(stage, Actions=actions))
+    return stages
+
+
+def base_template(stages=None):
+    key = dumps(PIPELINE_STAGES if stages is None else stages)
+    if key not in _base_templates:
+        _base_templates[key] = build_template(stages).to_dict()
+    return _base_templates[key]
+
+
+def dumps(value, indent=None):
+    if indent is None:
+        return json.dumps(value, separators=(',', ':'), sort_keys=True)
+    return json.dumps(value, indent=indent, sort_keys=True)
+
+
+def project_parameters(config):
+    template = base_template(pipeline_stages(config))
+    parameters = config.get('Parameters', {})
+    unknown = sorted(set(parameters) - set(template['Parameters']))
+    if unknown:
+        raise ValueError('unknown template parameters: %s' % ', '.join(unknown))
+    declared = dict(template['Parameters'])
+    for name, value in parameters.items():
+        declared[name] = dict(template['Parameters'][name], Default=str(value))
+    return declared
+
+
+def render(config, indent=None):
+    # Only the parameter declarations differ between projects, so the rest of the template is serialized once and
+    # each project's Parameters section is spliced into it, indented to the depth it sits at.
+    stages = pipeline_stages(config)
+    key = dumps(stages), indent
+    if key not in _base_text:
+        _base_text[key] = dumps(dict(base_template(stages), Parameters='@@Parameters@@'), indent)
+    section = dumps(project_parameters(config), indent)
+    if indent is not None:
+        section = section.replace('\n', '\n' + ' ' * indent)
+    return _base_text[key].replace(PARAMETERS_PLACEHOLDER, section, 1)
+
+
+def template_references(value, found=None):
+    # Names used by Ref, Fn::GetAtt, Fn::If and Condition anywhere in value.
+    found = set() if found is None else found
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'Ref' and isinstance(item, str):
+                found.add(item)
+            elif key == 'Fn::GetAtt':
+                found.add(item[0] if isinstance(item, list) else item.split('.')[0])
+            elif key == 'Fn::If':
+                found.add(item[0])
+            elif key == 'Condition' and isinstance(item, str):
+                found.add(item)
+            template_references(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            template_references(item, found)
+    return found
+
+
+def stack_layers(resources):
+    layer = dict((name, STACK_LAYERS.index(LAYER_TYPES.get(resource['Type'], STACK_LAYERS[-1])))
+                 for name, resource in resources.items())
+    depends = dict((name, set(template_references(resource)) | set(resource.get('DependsOn', [])))
+                   for name, resource in resources.items())
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(resources):
+            latest = max([layer[other] for other in depends[name] if other in resources] + [layer[name]])
+            if latest > layer[name]:
+                layer[name] = latest
+                changed = True
+    return dict((name, STACK_LAYERS[index]) for name, index in layer.items())
+
+
+def split_template(template):
+    """Split template into a parent stack and one nested stack per layer that has resources.
+
+    References to a resource in another layer become a parameter of the nested stack, fed from an output of the
+    stack that owns the resource; template parameters and conditions are copied into the nested stacks that use them.
+    Returns the parent template and the nested templates by layer.
+    """
+    resources = template['Resources']
+    layers = stack_layers(resources)
+    conditions = template.get('Conditions', {})
+    children = {}
+    exports = {}
+
+    def localize(value, layer, imports):
+        if isinstance(value, dict):
+            if 'Ref' in value and layers.get(value['Ref'], layer) != layer:
+                name = value['Ref'] + 'Ref'
+                imports[name] = (value['Ref'], None)
+                return {'Ref': name}
+            if 'Fn::GetAtt' in value:
+                target, attribute = value['Fn::GetAtt']
+                if layers.get(target, layer) != layer:
+                    name = target + attribute.replace('.', '')
+                    imports[name] = (target, attribute)
+                    return {'Ref': name}
+            return dict((key, localize(item, layer, imports)) for key, item in value.items())
+        if isinstance(value, list):
+            return [localize(item, layer, imports) for item in value]
+        return value
+
+    stack_parameters = {}
+    for layer in STACK_LAYERS:
+        names = sorted(name for name in resources if layers[name] == layer)
+        if not names:
+            continue
+        imports = {}
+        child_resources = {}
+        depends_on = set()
+        for name in names:
+            resource = localize(resources[name], layer, imports)
+            if 'DependsOn' in resource:
+                depends = resource['DependsOn'] if isinstance(resource['DependsOn'], list) else [resource['DependsOn']]
+                depends_on.update(layers[other] for other in depends if layers[other] != layer)
+                resource['DependsOn'] = [other for other in depends if layers[other] == layer]
+                if not resource['DependsOn']:
+                    del resource['DependsOn']
+            child_resources[name] = resource
+        used = template_references(child_resources)
+        child_conditions = dict((name, conditions[name]) for name in sorted(used) if name in conditions)
+        used |= template_references(child_conditions)
+        parameters = dict((name, template['Parameters'][name]) for name in used if name in template['Parameters'])
+        for name, (target, attribute) in imports.items():
+            parameters[name] = {'Type': 'String'}
+            exports.setdefault(layers[target], {})[name] = {
+                'Value': {'Ref': target} if attribute is None else {'Fn::GetAtt': [target, attribute]}}
+        child = {'Description': '%s (%s)' % (template['Description'], layer), 'Parameters': parameters,
+                 'Resources': child_resources}
+        if child_conditions:
+            child['Conditions'] = child_conditions
+        children[layer] = child
+        stack_parameters[layer] = dict(
+            [(name, {'Ref': name}) for name in parameters if name in template['Parameters']] +
+            [(name, {'Fn::GetAtt': [layers[target] + 'stack', 'Outputs.' + name]})
+             for name, (target, _) in imports.items()])
+        if depends_on:
+            stack_parameters[layer, 'DependsOn'] = sorted(other + 'stack' for other in depends_on)
+
+    for layer, outputs in exports.items():
+        children[layer]['Outputs'] = outputs
+
+    parent_parameters = dict(template['Parameters'])
+    parent_parameters['templatebucketparameter'] = {
+        'Type': 'String',
+        'Description': 'The bucket the nested stack templates are uploaded to, under <projectnameparameter>/.',
+        'MinLength': '1'
+    }
+    parent = {'Description': template['Description'], 'Parameters': parent_parameters, 'Resources': {}}
+    if 'Metadata' in template:
+        parent['Metadata'] = template['Metadata']
+    for layer in children:
+        stack = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': {'Fn::Join': ['', ['https://', {'Ref': 'templatebucketparameter'}, '.s3.amazonaws.com/',
+                                                  {'Ref': 'projectnameparameter'}, '/@@%s@@' % layer]]},
+                'Parameters': stack_parameters[layer]
+            }
+        }
+        if (layer, 'DependsOn') in stack_parameters:
+            stack['DependsOn'] = stack_parameters[layer, 'DependsOn']
+        parent['Resources'][layer + 'stack'] = stack
+    return parent, children
+
+
+def output_path(config):
+    if 'Output' in config:
+        return config['Output']
+    return config.get('Parameters', {}).get('projectnameparameter', 'pipeline') + '.json'
+
+
+def write_if_changed(path, text):
+    # Returns whether the file was written. Leaving unchanged files alone keeps their mtimes, so whatever deploys the
+    # templates downstream only sees the projects that actually changed.
+    data = text.encode('utf-8')
+    if os.path.exists(path):
+        with open(path, 'rb') as existing:
+            if hashlib.sha256(existing.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as rendered:
+        rendered.write(data)
+    os.rename(tmp_path, path)
+    return True
+
+
+def render_files(config, indent=None, split_threshold=INLINE_TEMPLATE_LIMIT):
+    # Returns the text of every file that makes up the project's stack, by path.
+    path = output_path(config)
+    text = render(config, indent)
+    if len(text.encode('utf-8')) <= split_threshold:
+        return {path: text}
+    template = base_template(pipeline_stages(config))
+    parent, children = split_template(dict(template, Parameters=project_parameters(config)))
+    stem = os.path.splitext(path)[0]
+    files = {}
+    parent_text = dumps(parent, indent)
+    for layer, child in children.items():
+        child_path = '%s-%s.json' % (stem, layer)
+        files[child_path] = dumps(child, indent)
+        parent_text = parent_text.replace('@@%s@@' % layer, os.path.basename(child_path))
+    files[path] = parent_text
+    return files
+
+
+def render_to_file(config, indent=None, split_threshold=INLINE_TEMPLATE_LIMIT):
+    files = render_files(config, indent, split_threshold)
+    changed = [write_if_changed(path, text) for path, text in sorted(files.items())]
+    return output_path(config), any(changed), dict((path, len(text.encode('utf-8'))) for path, text in files.items())
+
+
+def render_all(configs, workers=None, indent=None, split_threshold=INLINE_TEMPLATE_LIMIT):
+    # The base templates are built before the pool starts, so forked workers inherit them instead of each building
+    # their own; the workers then only serialize, hash and write.
+    for config in configs:
+        base_template(pipeline_stages(config))
+    render_one = functools.partial(render_to_file, indent=indent, split_threshold=split_threshold)
+    if workers == 1 or len(configs) < 2:
+        return [render_one(config) for config in configs]
+    chunksize = max(1, len(configs) // (4 * (workers or os.cpu_count() or 1)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render_one, configs, chunksize=chunksize))
+
+
+def benchmark(count, workers=None):
+    configs = [{'Parameters': {'projectnameparameter': 'project%d' % i, 'accountparameter': str(100000000000 + i)}}
+               for i in range(count)]
+    directory = tempfile.mkdtemp(prefix='hydrate-bench-')
+    for config in configs:
+        config['Output'] = os.path.join(directory, config['Parameters']['projectnameparameter'] + '.json')
+    started = time.time()
+    base_template()
+    built = time.time()
+    written = sum(changed for _, changed, _ in render_all(configs, workers))
+    rendered = time.time()
+    unchanged = sum(not changed for _, changed, _ in render_all(configs, workers))
+    rerendered = time.time()
+    print('built the base template in %.3fs' % (built - started))
+    print('rendered %d templates (%d written) in %.3fs' % (count, written, rendered - built))
+    print('rendered them again (%d unchanged) in %.3fs' % (unchanged, rerendered - rendered))
+    print('output in %s' % directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the ML pipeline CloudFormation template. With no arguments it '
+                                                 'writes pipeline.json with the default parameters.')
+    parser.add_argument('configs', nargs='*', metavar='CONFIG',
+                        help='JSON files, each holding a list of project configs to render')
+    parser.add_argument('--workers', type=int, help='processes to render with (default: one per cpu)')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='time rendering N made up projects into a temp dir')
+    parser.add_argument('--indent', type=int, help='pretty print with this indent instead of minifying')
+    parser.add_argument('--split-threshold', type=int, default=INLINE_TEMPLATE_LIMIT,
+                        help='split templates bigger than this many bytes into nested stacks (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.workers)
+        return
+    if not args.configs:
+        # This prints out the CFN template. Oh and don't print to yaml. There's either some bug with tropophere or with
+        # CF that causes templates to fail legacy parsing when submitted to CF in yaml format. It's certainly easier to
+        # look at but I got tired to troubleshooting.
+        configs = [{'Output': 'pipeline.json'}]
+    else:
+        configs = []
+        for path in args.configs:
+            with open(path) as config_file:
+                configs.extend(json.load(config_file))
+    for path, changed, sizes in render_all(configs, args.workers, args.indent, args.split_threshold):
+        print('%s %s (%s)' % ('wrote' if changed else 'unchanged', path,
+                              ', '.join('%s: %d bytes' % (name, size) for name, size in sorted(sizes.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+
+# Run from the build stage, in the checked out ML repo, to skip docker builds the commit doesn't need. The training
+# image only depends on the Dockerfile and the sources the manifest lists under BuildSources (train and serve by
+# default), so those are hashed, and an image built from them is also pushed as src-<hash>. When a later commit leaves
+# them alone the image for it is already in ECR, and all that's left is to tag it with the new commit id, which is a
+# manifest copy rather than a build and push. sageDispatch pins jobs to the image digest, so a reused image is also
+# recognised as the same image by the job index.
+#
+#   SOURCE_HASH=$(python image_hash.py)
+#   python image_hash.py --alias $CODEBUILD_RESOLVED_SOURCE_VERSION || <docker build, tag src-$SOURCE_HASH, push both>
+SOURCE_TAG_PREFIX = 'src-'
+DEFAULT_BUILD_SOURCES = ['train', 'serve']
+HASH_BLOCK_BYTES = 1024 * 1024
+EXIT_NOT_FOUND = 3
+
+
+def build_sources(root, manifest_path):
+  sources = DEFAULT_BUILD_SOURCES
+  path = os.path.join(root, manifest_path)
+  if os.path.exists(path):
+    with open(path) as manifest_file:
+      sources = json.load(manifest_file).get('BuildSources', sources)
+  return ['Dockerfile'] + list(sources)
+
+
+def source_files(root, patterns):
+  # Patterns are globs relative to root; a directory stands for everything under it.
+  files = set()
+  for pattern in patterns:
+    for match in glob.glob(os.path.join(root, pattern)):
+      if os.path.isdir(match):
+        for directory, dirs, names in os.walk(match):
+          files.update(os.path.join(directory, name) for name in names)
+      else:
+        files.add(match)
+  return sorted(os.path.relpath(path, root).replace(os.sep, '/') for path in files)
+
+
+def source_hash(root='.', manifest_path='manifest.json'):
+  # Names and the executable bit go into the hash along with the content, since both change what the image does.
+  digest = hashlib.sha256()
+  for name in source_files(root, build_sources(root, manifest_path)):
+    path = os.path.join(root, name)
+    file_digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+      for block in iter(lambda: source.read(HASH_BLOCK_BYTES), b''):
+        file_digest.update(block)
+    digest.update(('%s\0%d\0%s\n' % (name, os.access(path, os.X_OK), file_digest.hexdigest())).encode('utf-8'))
+  return digest.hexdigest()
+
+
+def alias_image(ecr_client, repository, source_tag, tag):
+  # Returns the digest of the image now tagged with tag, or None when nothing was pushed as source_tag yet.
+  response = ecr_client.batch_get_image(repositoryName=repository, imageIds=[{'imageTag': source_tag}],
+                                        acceptedMediaTypes=['application/vnd.docker.distribution.manifest.v2+json',
+                                                            'application/vnd.oci.image.manifest.v1+json'])
+  if not response['images']:
+    return None
+  image = response['images'][0]
+  try:
+    ecr_client.put_image(repositoryName=repository, imageManifest=image['imageManifest'],
+                         imageManifestMediaType=image.get('imageManifestMediaType',
+                                                          'application/vnd.docker.distribution.manifest.v2+json'),
+                         imageTag=tag)
+  except ecr_client.exceptions.ImageAlreadyExistsException:
+    pass
+  return image['imageId']['imageDigest']
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Hash the training image sources and reuse an image built from them.')
+  parser.add_argument('--root', default='.', help='checkout to hash (default: %(default)s)')
+  parser.add_argument('--manifest', default='manifest.json', help='manifest path under root (default: %(default)s)')
+  parser.add_argument('--alias', metavar='TAG',
+                      help='tag the image built from these sources with TAG; exits %d if there is none' % EXIT_NOT_FOUND)
+  parser.add_argument('--repository', default=os.environ.get('IMAGE_REPO_NAME'),
+                      help='ECR repository (default: $IMAGE_REPO_NAME)')
+  args = parser.parse_args()
+
+  tag = SOURCE_TAG_PREFIX + source_hash(args.root, args.manifest)
+  if not args.alias:
+    print(tag[len(SOURCE_TAG_PREFIX):])
+    return
+  if not args.repository:
+    parser.error('--repository or IMAGE_REPO_NAME is needed with --alias')
+  import boto3
+  digest = alias_image(boto3.client('ecr'), args.repository, tag, args.alias)
+  if digest is None:
+    sys.stderr.write('no image for %s yet, build it\n' % tag)
+    sys.exit(EXIT_NOT_FOUND)
+  sys.stderr.write('tagged %s (%s) as %s, skipping the build\n' % (tag, digest, args.alias))
+
+
+if __name__ == '__main__':
+  main()
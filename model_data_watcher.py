@@ -1,6 +1,140 @@
-import boto3
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from urllib.parse import unquote_plus
+
+import sageDispatch
+import state_store
+from sageDispatch import client
+
+log = logging.getLogger()
+
+# Uploading a dataset fires one event per object, and starting the pipeline for each of them would queue a training
+# run per file. Instead every object event is written to the state store as a pending record, and the pending records
+# are flushed into a single pipeline execution once no new object has arrived for QUIET_SECONDS, or straight away when
+# an object named like DONE_MARKER (e.g. a _SUCCESS file written last by the job that produced the data) lands. A
+# scheduled event checks the quiet window. Each flush writes the batch of object versions that went into it next to
+# the pending records, keyed by pipeline execution id.
+#
+# Each event gets its own record, so concurrent invocations never overwrite each other, and only one invocation at a
+# time flushes, behind a lock record made with the store's exclusive create. A lock older than LOCK_SECONDS is taken
+# to belong to an invocation that died and is broken. WATCH_STATE can be a local directory to run all of this offline.
+# The record of a DONE_MARKER object is named with DONE_SUFFIX, so the flush it asks for is in the store rather than
+# in the invocation that saw it: when that invocation finds the lock taken, the holder sees the record once it lets go
+# of the lock and flushes again.
+QUIET_SECONDS = float(os.environ.get('QUIET_SECONDS', '300'))
+DONE_MARKER = os.environ.get('DONE_MARKER', '_SUCCESS')
+LOCK_SECONDS = 120
+PENDING_PREFIX = 'pending/'
+BATCH_PREFIX = 'batches/'
+FLUSH_LOCK = 'flush.lock'
+DONE_SUFFIX = '-done.json'
+
+_watch_state = None
+
+
+def get_watch_state():
+  global _watch_state
+  if _watch_state is None:
+    _watch_state = state_store.open_store(os.environ['WATCH_STATE'], client('s3'))
+  return _watch_state
 
-code_pipeline = boto3.client('codepipeline')
 
 def handler(event, context):
-  code_pipeline.start_pipeline_execution(name='ml_pipeline')
+  sageDispatch.configure_logging()
+  log.debug(event)
+  store = get_watch_state()
+  for obj in event_objects(event):
+    record_pending(store, obj)
+  return flush(store)
+
+
+def event_objects(event):
+  # S3 notifications (directly or through SNS) carry Records; EventBridge "Object Created" events carry one object in
+  # detail. Scheduled events carry none and only get the quiet window checked.
+  if event.get('detail-type') == 'Object Created':
+    detail = event['detail']
+    return [{'Bucket': detail['bucket']['name'], 'Key': detail['object']['key'],
+             'VersionId': detail['object'].get('version-id'), 'Size': detail['object'].get('size'),
+             'ETag': detail['object'].get('etag'), 'EventTime': event.get('time')}]
+  objects = []
+  for record in event.get('Records', []):
+    records = json.loads(record['Sns']['Message']).get('Records', []) if 'Sns' in record else [record]
+    for s3_record in records:
+      if not s3_record.get('eventName', '').startswith('ObjectCreated:'):
+        continue
+      obj = s3_record['s3']['object']
+      # Keys in S3 notifications are url encoded, EventBridge ones aren't.
+      objects.append({'Bucket': s3_record['s3']['bucket']['name'], 'Key': unquote_plus(obj['key']),
+                      'VersionId': obj.get('versionId'),
+                      'Size': obj.get('size'), 'ETag': obj.get('eTag'), 'EventTime': s3_record.get('eventTime')})
+  return objects
+
+
+def record_pending(store, obj):
+  # Names start with the arrival time, so they sort by it and the quiet window can be checked from a listing alone.
+  obj = dict(obj, Received=time.time())
+  suffix = DONE_SUFFIX if obj['Key'].split('/')[-1] == DONE_MARKER else '.json'
+  name = '%s%017.6f-%s%s' % (PENDING_PREFIX, obj['Received'], uuid.uuid4().hex[:8], suffix)
+  store.put(name, json.dumps(obj, sort_keys=True).encode('utf-8'))
+
+
+def flush(store, force=False, now=None):
+  while True:
+    result = flush_pending(store, force, time.time() if now is None else now)
+    # A done record that arrived while the lock was held was left for us; a taken lock leaves it to its new holder.
+    if result['Reason'] == 'locked' or not any(name.endswith(DONE_SUFFIX) for name in store.list(PENDING_PREFIX)):
+      return result
+    force = False
+
+
+def flush_pending(store, force, now):
+  if not acquire_lock(store, now):
+    log.info("another invocation is flushing")
+    return {'Started': False, 'Reason': 'locked'}
+  try:
+    names = store.list(PENDING_PREFIX)
+    if not names:
+      return {'Started': False, 'Reason': 'nothing pending'}
+    force = force or any(name.endswith(DONE_SUFFIX) for name in names)
+    newest = float(names[-1][len(PENDING_PREFIX):].split('-')[0])
+    if not force and now - newest < QUIET_SECONDS:
+      log.info("%d objects pending, waiting for %.0fs without uploads", len(names), QUIET_SECONDS)
+      return {'Started': False, 'Reason': 'waiting', 'Pending': len(names)}
+
+    pending = [json.loads(data) for data in (store.get(name) for name in names) if data is not None]
+    objects = sorted(pending, key=lambda obj: (obj['Bucket'], obj['Key'], obj['Received']))
+    batch = json.dumps({'Objects': objects}, sort_keys=True).encode('utf-8')
+    execution = client('codepipeline').start_pipeline_execution(name=os.environ['PIPELINE_NAME'])
+    execution_id = execution['pipelineExecutionId']
+    store.put('%s%s.json' % (BATCH_PREFIX, execution_id), batch)
+    # Only the records that went into this batch are cleared; anything that arrived meanwhile waits for the next one.
+    for name in names:
+      store.delete(name)
+    log.info("started %s for %d objects", execution_id, len(objects))
+    return {'Started': True, 'Reason': 'done' if force else 'quiet', 'PipelineExecutionId': execution_id,
+            'Objects': len(objects), 'BatchHash': hashlib.sha256(batch).hexdigest()}
+  finally:
+    store.delete(FLUSH_LOCK)
+
+
+def acquire_lock(store, now):
+  if store.create(FLUSH_LOCK, json.dumps({'Acquired': now}).encode('utf-8')):
+    return True
+  held = store.get(FLUSH_LOCK)
+  if held is None:
+    # Released since we tried.
+    return store.create(FLUSH_LOCK, json.dumps({'Acquired': now}).encode('utf-8'))
+  try:
+    acquired = json.loads(held)['Acquired']
+  except ValueError:
+    # Still being written by whoever just took it.
+    return False
+  if now - acquired < LOCK_SECONDS:
+    return False
+  log.warning("breaking a flush lock held since %s", acquired)
+  store.delete(FLUSH_LOCK)
+  return store.create(FLUSH_LOCK, json.dumps({'Acquired': now}).encode('utf-8'))
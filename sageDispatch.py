@@ -1,135 +1,814 @@
 import boto3
+import botocore.session
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import io
 import json
-import tempfile
 import zipfile
-import datetime
 import os
 import logging
+import random
+import re
+import threading
+import time
+from botocore.exceptions import ClientError
+
+import state_store
 
-log_level = os.environ['LOG_LEVEL']
-formatter = logging.Formatter('[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
-                              '%m-%d %H:%M:%S')
-if log_level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
-  log_level = 'WARNING'
 log = logging.getLogger()
-log.setLevel(log_level)
-ch = logging.StreamHandler()
-ch.setLevel(log_level)
-log.addHandler(ch)
-ch.setFormatter(formatter)
+# The end of central directory record is 22 bytes and may be followed by a comment of up to 64KB, so a suffix read of
+# this size always contains it and, for the artifacts we produce, usually the whole central directory as well.
+ZIP_TAIL_BYTES = 64 * 1024 + 22
+ZIP_READ_BUFFER_BYTES = 64 * 1024
+
+# Parsed manifests are kept for the life of the container so pipeline retries and re-runs of an artifact skip s3.
+MANIFEST_CACHE_ENTRIES = int(os.environ.get('MANIFEST_CACHE_ENTRIES', '32'))
+MANIFEST_CACHE_BYTES = int(os.environ.get('MANIFEST_CACHE_BYTES', str(4 * 1024 * 1024)))
+MANIFEST_CACHE_DIR = os.environ.get('MANIFEST_CACHE_DIR', '')
+
+# The s3 and codecommit lookups that precede create_training_job are independent network round trips, so they are
+# issued side by side on a pool that is kept warm with the container.
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '4'))
+
+# A job's data is pinned by a snapshot of every object version under its input channels, listed with
+# list_object_versions a page at a time (one request per 1000 objects instead of a HEAD per object) and with the
+# channels listed side by side. The snapshot is written to DATA_SNAPSHOTS under its own hash, and that hash is what
+# jobs are tagged and fingerprinted with.
+SNAPSHOT_PAGE_SIZE = 1000
+
+# A manifest with a Jobs list fans out into one training job per entry. CreateTrainingJob has a low per-account TPS
+# limit, so submissions go through a client side token bucket and are retried with jittered backoff when throttled.
+SUBMIT_RATE = float(os.environ.get('SUBMIT_RATE', '1'))
+SUBMIT_BURST = int(os.environ.get('SUBMIT_BURST', '2'))
+SUBMIT_ATTEMPTS = int(os.environ.get('SUBMIT_ATTEMPTS', '5'))
+SUBMIT_BACKOFF_SECONDS = 1.0
+SUBMIT_BACKOFF_CAP_SECONDS = 20.0
+RETRYABLE_SUBMIT_ERRORS = ('ThrottlingException', 'ResourceLimitExceeded')
+
+# A job spec with a HyperParameterTuning section is launched as a tuning job that warm starts from the best tuning job
+# of the same spec on the nearest ancestor commit. The image changes with every commit, so the warm start type has to
+# be TransferLearning rather than IdenticalDataAndAlgorithm.
+TRAINING_JOB_NAME_LENGTH = 63
+TUNING_JOB_NAME_LENGTH = 32
+WARM_START_LOOKBACK = int(os.environ.get('WARM_START_LOOKBACK', '5'))
+WARM_START_TYPE = 'TransferLearning'
+
+# Every job spec is fingerprinted over the training image digest, the versions of its data objects and the spec itself.
+# The job index maps fingerprints to the job that was launched for them, so a re-run or an unrelated commit that
+# changes none of those reuses that job instead of training again. Job names are derived from the fingerprint too.
+# A job that is Stopping always ends up Stopped, so it is retried rather than reused.
+FINGERPRINT_NAME_LENGTH = 12
+REUSABLE_JOB_STATES = ('InProgress', 'Completed')
 
-log.info("The log level is %s", log_level)
+# The Train action is only marked done once every job it dispatched has finished. Until then each invocation hands
+# CodePipeline a continuation token naming the jobs, and CodePipeline invokes us again later to check on them, so no
+# invocation ever waits on a job. Tokens are capped at 2048 characters, about 25 jobs, so a longer job list is kept in
+# the job index under its hash and the token only names it.
+CONTINUATION_TOKEN_LENGTH = 2048
+CONTINUATION_PREFIX = 'continuations/'
+RUNNING_JOB_STATES = ('InProgress', 'Stopping')
+FAILED_JOB_STATES = ('Failed', 'Stopped')
 
-code_pipeline = boto3.client('codepipeline')
-s3 = boto3.client('s3')
-s3resource = boto3.resource('s3')
-sagemaker = boto3.client('sagemaker')
-codecommit = boto3.client('codecommit')
+# A manifest (or a Jobs entry) with "EnableManagedSpotTraining": true runs on spot capacity, waiting for it up to
+# MaxWaitTimeInSeconds in all (MaxRuntimeInSeconds times SPOT_MAX_WAIT_FACTOR by default). Spot jobs, and jobs with
+# "Checkpoints": true, sync /opt/ml/checkpoints with a prefix under CHECKPOINTS named after the spec and its
+# fingerprint, so an interrupted job picks up from its last checkpoint, and so does a retry of the same fingerprint.
+SPOT_MAX_WAIT_FACTOR = 2
+
+# Manifests can declare their own input channels, e.g. sharded, gzipped train/validation/test prefixes read in Pipe
+# mode, so each instance of a multi-instance job only streams its own shard. Without Channels a job gets the one
+# fully replicated train channel over the whole input bucket.
+DEFAULT_CHANNEL = {'ChannelName': 'train'}
+DispatchInputs = collections.namedtuple('DispatchInputs', ['manifest', 'commit_id', 'data_snapshots', 'image_digest'])
+
+# Clients are built on first use from one shared session, so an invocation only pays endpoint resolution and service
+# model loading for the services it actually calls, and each service model is loaded once per container.
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+_logging_configured = False
+_job_index = None
+_snapshot_store = None
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=DISPATCH_WORKERS)
+
+
+def configure_logging():
+  global _logging_configured
+  if _logging_configured:
+    return
+  log_level = os.environ.get('LOG_LEVEL', 'WARNING')
+  formatter = logging.Formatter('[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
+                                '%m-%d %H:%M:%S')
+  if log_level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+    log_level = 'WARNING'
+  log.setLevel(log_level)
+  ch = logging.StreamHandler()
+  ch.setLevel(log_level)
+  log.addHandler(ch)
+  ch.setFormatter(formatter)
+  _logging_configured = True
+  log.info("The log level is %s", log_level)
+
+
+def client(service_name):
+  global _session
+  with _clients_lock:
+    if service_name not in _clients:
+      if _session is None:
+        _session = boto3.session.Session(botocore_session=botocore.session.get_session())
+      _clients[service_name] = _session.client(service_name)
+    return _clients[service_name]
 
 
 def lambda_handler(event, context):
+  configure_logging()
   log.debug(event)
+  process_job(event['CodePipeline.job']['id'], event['CodePipeline.job']['data'])
+
 
+def process_job(job_id, job_data, codepipeline=None):
+  # Shared by the Lambda and by dispatch_worker, which hands in the client it polled the job from.
+  codepipeline = codepipeline or client('codepipeline')
   try:
-    job_id = event['CodePipeline.job']['id']
-    job_data = event['CodePipeline.job']['data']
-    artifacts = job_data['inputArtifacts']
-    log.debug(artifacts)
-    manifest = get_manifest_dictionary(artifacts)
-    log.info("got manifest and sending job")
-    result = send_to_training(manifest)
-    log.debug(result)
-    if 'TrainingJobArn' in result:
-      put_job_success(job_id, 'started job: ' + result['TrainingJobArn'])
+    if 'continuationToken' in job_data:
+      jobs = continuation_jobs(job_data['continuationToken'])
+      log.info("checking on %d jobs", len(jobs))
+      results = list(executor.map(lambda job: describe_job(*job), jobs))
     else:
-      put_job_failure(job_id, 'Sagemaker training job failed.')
+      artifacts = job_data['inputArtifacts']
+      log.debug(artifacts)
+      inputs = resolve_dispatch_inputs(artifacts, action_variants(job_data))
+      log.info("got manifest and sending job")
+      results = send_to_training(inputs)
+    log.debug(results)
+    report_results(job_id, results, codepipeline)
   except Exception as e:
     log.critical(e)
-    code_pipeline.put_job_failure_result(jobId=job_id,
-                                         failureDetails={'message': 'some sort of exception', 'type': 'JobFailed'})
+    put_job_failure(job_id, '%s: %s' % (type(e).__name__, e), codepipeline)
 
 
-def send_to_training(manifest):
-  suffix = datetime.datetime.now().strftime("%y-%m-%d-%H-%M")
-  commit_id = codecommit.get_branch(repositoryName=os.environ['CODE_COMMIT_REPO'], branchName='master')['branch'][
-    'commitId']
-  try:
-    training_object = s3resource.Object(os.environ['INPUT_BUCKET'].split('/')[-2],
-                                        manifest['HyperParameters']['train_data'].split('/')[-1])
-    testing_object = s3resource.Object(os.environ['INPUT_BUCKET'].split('/')[-2],
-                                       manifest['HyperParameters']['test_data'].split('/')[-1])
-  except Exception as e:
-    log.critical(e)
+def report_results(job_id, results, codepipeline):
+  messages = [describe_result(result) for result in results]
+  if any('Error' in result or result['Status'] in FAILED_JOB_STATES for result in results):
+    put_job_failure(job_id, '; '.join(['Sagemaker training job failed.'] + messages), codepipeline)
+  elif any(result['Status'] in RUNNING_JOB_STATES for result in results):
+    token = continuation_token([[result['JobType'], result['JobName']] for result in results])
+    if token is None:
+      put_job_failure(job_id, '%d jobs are too many to check on without a JOB_INDEX to keep the list in; %s' % (
+        len(results), '; '.join(messages)), codepipeline)
+    else:
+      put_job_success(job_id, '; '.join(messages), codepipeline, continuation_token=token)
+  else:
+    put_job_success(job_id, '; '.join(messages), codepipeline)
+
+
+def continuation_token(jobs):
+  token = json.dumps(jobs, separators=(',', ':'))
+  if len(token) <= CONTINUATION_TOKEN_LENGTH:
+    return token
+  job_index = get_job_index()
+  if job_index is None:
+    return None
+  name = CONTINUATION_PREFIX + hashlib.sha256(token.encode('utf-8')).hexdigest() + '.json'
+  job_index.put(name, token.encode('utf-8'))
+  return json.dumps({'Jobs': name}, separators=(',', ':'))
+
+
+def continuation_jobs(token):
+  jobs = json.loads(token)
+  if isinstance(jobs, dict):
+    stored = get_job_index().get(jobs['Jobs'])
+    if stored is None:
+      raise ValueError('the job list %s is gone from the job index' % jobs['Jobs'])
+    jobs = json.loads(stored)
+  return jobs
+
+
+def action_variants(job_data):
+  # A pipeline with one Train action per variant (see PIPELINE_STAGES in hydrate.py) names the variants each action
+  # dispatches in its UserParameters, e.g. {"Jobs": ["wide"]}. Without them the action dispatches every job.
+  parameters = job_data.get('actionConfiguration', {}).get('configuration', {}).get('UserParameters')
+  if not parameters:
+    return None
+  return json.loads(parameters)['Jobs']
+
+
+def select_variants(manifest, variants):
+  if variants is None:
+    return manifest
+  if not variants:
+    raise ValueError('the action names no jobs to dispatch in its UserParameters')
+  names = [job['Name'] for job in manifest.get('Jobs', [])]
+  missing = [variant for variant in variants if variant not in names]
+  if missing:
+    raise ValueError('the manifest declares no jobs named %s' % ', '.join(missing))
+  return dict(manifest, Jobs=[job for job in manifest['Jobs'] if job['Name'] in variants])
+
+
+def resolve_dispatch_inputs(artifacts, variants=None):
+  # The input channels come from the manifest, so their listings wait on it, but the commit lookup overlaps both.
+  manifest_future = executor.submit(get_manifest_dictionary, artifacts)
+  commit_future = executor.submit(get_commit_id, artifacts)
+  commit_id = commit_future.result()
+  digest_future = executor.submit(get_image_digest, commit_id)
+  manifest = select_variants(manifest_future.result(), variants)
+  return DispatchInputs(manifest, commit_id, snapshot_job_data(job_specs(manifest)), digest_future.result())
+
+
+def get_commit_id(artifacts):
+  # The source artifact's revision is the commit the pipeline checked out. Asking codecommit for the head of master
+  # instead costs a round trip and is wrong whenever master has moved on since the pipeline started.
+  for artifact in artifacts:
+    if os.environ['APP_BUNDLE'] in artifact['name'] and artifact.get('revision'):
+      return artifact['revision']
+  branch = client('codecommit').get_branch(repositoryName=os.environ['CODE_COMMIT_REPO'], branchName='master')
+  return branch['branch']['commitId']
+
+
+def snapshot_job_data(specs):
+  # Channels shared between jobs are only listed once. Returns each job's snapshot hash, by TrainingJobName.
+  sources = {}
+  for spec in specs:
+    for channel in job_channels(spec):
+      source = channel['DataSource']['S3DataSource']
+      sources.setdefault((source['S3Uri'], source['S3DataType']), None)
+  futures = dict((source, executor.submit(list_object_versions, *source)) for source in sources)
+  listings = dict((source, future.result()) for source, future in futures.items())
+  snapshots = {}
+  written = set()
+  for spec in specs:
+    objects = set()
+    for channel in job_channels(spec):
+      source = channel['DataSource']['S3DataSource']
+      objects.update(listings[source['S3Uri'], source['S3DataType']])
+    snapshot_hash, document = data_snapshot(sorted(objects))
+    if snapshot_hash not in written:
+      put_data_snapshot(snapshot_hash, document)
+      written.add(snapshot_hash)
+    snapshots[spec['TrainingJobName']] = snapshot_hash
+  return snapshots
+
+
+def list_object_versions(uri, data_type='S3Prefix'):
+  # Returns the current version of every object under uri as (s3 url, version id, size, ETag). For manifest file
+  # channels the uri names a single object, so anything else that merely shares its prefix is left out.
+  bucket, _, prefix = uri[len('s3://'):].partition('/')
+  objects = []
+  paginator = client('s3').get_paginator('list_object_versions')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': SNAPSHOT_PAGE_SIZE}):
+    for version in page.get('Versions', []):
+      if version['IsLatest'] and (data_type == 'S3Prefix' or version['Key'] == prefix):
+        objects.append(('s3://%s/%s' % (bucket, version['Key']), version['VersionId'], version['Size'],
+                        version['ETag']))
+  if not objects:
+    log.warning("no objects under %s", uri)
+  return objects
+
+
+def data_snapshot(objects):
+  # One line per object keeps the document small enough for tens of thousands of objects and easy to diff.
+  document = ''.join('%s\t%s\t%d\t%s\n' % entry for entry in objects).encode('utf-8')
+  return hashlib.sha256(document).hexdigest(), document
+
+
+def put_data_snapshot(snapshot_hash, document):
+  global _snapshot_store
+  if _snapshot_store is None and os.environ.get('DATA_SNAPSHOTS'):
+    _snapshot_store = state_store.open_store(os.environ['DATA_SNAPSHOTS'], client('s3'))
+  if _snapshot_store is not None:
+    _snapshot_store.put(snapshot_hash + '.tsv', document)
+
+
+def get_image_digest(commit_id):
+  repository = os.environ['TRAINING_IMAGE'].split('/')[-1]
+  images = client('ecr').describe_images(repositoryName=repository, imageIds=[{'imageTag': commit_id}])
+  return images['imageDetails'][0]['imageDigest']
+
+
+def job_specs(manifest):
+  # Each entry of Jobs is layered over the rest of the manifest, HyperParameters key by key, so variants only have to
+  # spell out what makes them different, e.g. {"Name": "deep", "HyperParameters": {"model_type": "deep"}}.
+  if 'Jobs' not in manifest:
+    return [manifest]
+  if not manifest['Jobs']:
+    # Nothing to dispatch would report success with an empty summary, which codepipeline rejects.
+    raise ValueError('the manifest has an empty Jobs list; leave Jobs out to train the manifest as one job')
+  base = dict((key, value) for key, value in manifest.items() if key != 'Jobs')
+  specs = []
+  for job in manifest['Jobs']:
+    spec = copy.deepcopy(base)
+    for key, value in job.items():
+      if key == 'HyperParameters':
+        spec.setdefault('HyperParameters', {}).update(value)
+      elif key != 'Name':
+        spec[key] = copy.deepcopy(value)
+    # Job names only allow alphanumerics and hyphens, and variant names like wide_deep are not always that tidy.
+    spec['TrainingJobName'] = base['TrainingJobName'] + '-' + re.sub('[^a-zA-Z0-9-]', '-', job['Name'])
+    specs.append(spec)
+  return specs
+
+
+def send_to_training(inputs):
+  futures = [executor.submit(dispatch_job, spec, inputs) for spec in job_specs(inputs.manifest)]
+  return [future.result() for future in futures]
+
+
+def dispatch_job(spec, inputs):
+  fingerprint = job_fingerprint(spec, inputs)
+  job_type = 'HyperParameterTuningJob' if 'HyperParameterTuning' in spec else 'TrainingJob'
+  job_index = get_job_index()
+  entry = None
+  if job_index is not None:
+    entry = job_index.get(fingerprint + '.json')
+  attempt = 1
+  if entry is not None:
+    entry = json.loads(entry)
+    existing = describe_job(entry['JobType'], entry['JobName'])
+    if existing['Status'] in REUSABLE_JOB_STATES:
+      log.info("%s is unchanged since %s, reusing it", spec['TrainingJobName'], entry['JobName'])
+      existing['Reused'] = True
+      return existing
+    attempt = entry['Attempt'] + 1
+  if job_type == 'HyperParameterTuningJob':
+    job_name = fingerprint_job_name(spec, fingerprint, attempt, TUNING_JOB_NAME_LENGTH)
+    result = submit_job(create_tuning_job, job_type, spec, job_name, inputs)
+  else:
+    job_name = fingerprint_job_name(spec, fingerprint, attempt, TRAINING_JOB_NAME_LENGTH)
+    result = submit_job(create_training_job, job_type, spec, job_name, inputs)
+  if job_index is not None and 'JobArn' in result:
+    entry = {'JobType': job_type, 'JobName': job_name, 'Attempt': attempt}
+    job_index.put(fingerprint + '.json', json.dumps(entry).encode('utf-8'))
+  return result
+
+
+def job_fingerprint(spec, inputs):
+  document = json.dumps({'image': inputs.image_digest, 'data': inputs.data_snapshots[spec['TrainingJobName']],
+                         'spec': spec},
+                        sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def fingerprint_job_name(spec, fingerprint, attempt, max_length):
+  # Names have to be unique for good, so a spec whose last job failed is retried under a numbered name.
+  suffix = fingerprint[:FINGERPRINT_NAME_LENGTH]
+  if attempt > 1:
+    suffix += '-%d' % attempt
+  return spec['TrainingJobName'][:max_length - len(suffix) - 1].rstrip('-') + '-' + suffix
+
+
+def get_job_index():
+  global _job_index
+  if _job_index is None and os.environ.get('JOB_INDEX'):
+    _job_index = state_store.open_store(os.environ['JOB_INDEX'], client('s3'))
+  return _job_index
 
-  try:
-    response = sagemaker.create_training_job(
-      TrainingJobName=manifest['TrainingJobName'] + "-" + suffix,
-      HyperParameters=manifest['HyperParameters'],
-      AlgorithmSpecification={
-        'TrainingInputMode': 'File',
-        'TrainingImage': os.environ['TRAINING_IMAGE'] + ":" + commit_id
-      },
-      RoleArn=os.environ['SAGEMAKER_ROLE_ARN'],
-      InputDataConfig=[
-        {
-          "CompressionType": "None",
-          "ChannelName": "train",
-          "DataSource": {
-            "S3DataSource": {
-              "S3DataType": "S3Prefix",
-              "S3DataDistributionType": "FullyReplicated",
-              "S3Uri": os.environ['INPUT_BUCKET']
-            }
-          },
-          "RecordWrapperType": "None"
-        }
-      ],
-      OutputDataConfig={
-        "KmsKeyId": os.environ['BUCKET_KEY_ARN'].split('/')[-1],
-        "S3OutputPath": os.environ['OUTPUT_BUCKET']
-      },
-      ResourceConfig=manifest['ResourceConfig'],
-      StoppingCondition=manifest['StoppingCondition'],
-      Tags=[{'Key': 'commitID', 'Value': commit_id},
-            {'Key': 'training_data_version', 'Value': training_object.version_id},
-            {'Key': 'testing_data_version', 'Value': testing_object.version_id}]
-    )
-  except Exception as e:
-    log.critical(e)
-  return response
+
+def describe_job(job_type, job_name):
+  result = {'JobName': job_name, 'JobType': job_type}
+  if job_type == 'HyperParameterTuningJob':
+    job = client('sagemaker').describe_hyper_parameter_tuning_job(HyperParameterTuningJobName=job_name)
+    result['JobArn'] = job['HyperParameterTuningJobArn']
+    result['Status'] = job['HyperParameterTuningJobStatus']
+    if 'BestTrainingJob' in job:
+      result['BestTrainingJob'] = job['BestTrainingJob']['TrainingJobName']
+      metric = job['BestTrainingJob'].get('FinalHyperParameterTuningJobObjectiveMetric')
+      if metric:
+        result['FinalMetricDataList'] = [{'MetricName': metric['MetricName'], 'Value': metric['Value']}]
+  else:
+    job = client('sagemaker').describe_training_job(TrainingJobName=job_name)
+    result['JobArn'] = job['TrainingJobArn']
+    result['Status'] = job['TrainingJobStatus']
+    for key in ('TrainingTimeInSeconds', 'BillableTimeInSeconds', 'FinalMetricDataList'):
+      if key in job:
+        result[key] = job[key]
+    if job.get('EnableManagedSpotTraining') and job.get('TrainingTimeInSeconds') and 'BillableTimeInSeconds' in job:
+      # Spot jobs are billed for BillableTimeInSeconds at the on demand rate, so this is what spot saved over it.
+      saved = 1 - float(job['BillableTimeInSeconds']) / job['TrainingTimeInSeconds']
+      result['SavedPercent'] = round(100.0 * saved, 1)
+    if 'ModelArtifacts' in job:
+      result['ModelArtifacts'] = job['ModelArtifacts']['S3ModelArtifacts']
+  if 'FailureReason' in job:
+    result['FailureReason'] = job['FailureReason']
+  return result
+
+
+def describe_result(result):
+  if 'Error' in result:
+    return '%s failed: %s' % (result['JobName'], result['Error'])
+  if result.get('Started'):
+    return 'started job: ' + result['JobArn']
+  details = [result['Status']]
+  if 'FailureReason' in result:
+    details.append(result['FailureReason'])
+  if 'TrainingTimeInSeconds' in result:
+    billable = result.get('BillableTimeInSeconds', result['TrainingTimeInSeconds'])
+    details.append('%ds training, %ds billable' % (result['TrainingTimeInSeconds'], billable))
+  if 'SavedPercent' in result:
+    details.append('%g%% saved by spot' % result['SavedPercent'])
+  for metric in result.get('FinalMetricDataList', []):
+    details.append('%s=%g' % (metric['MetricName'], metric['Value']))
+  if 'ModelArtifacts' in result:
+    details.append('model ' + result['ModelArtifacts'])
+  if 'BestTrainingJob' in result:
+    details.append('best job ' + result['BestTrainingJob'])
+  return '%s: %s (%s)' % ('reused job' if result.get('Reused') else 'job', result['JobArn'], ', '.join(details))
+
+
+def submit_job(create, job_type, spec, job_name, inputs):
+  for attempt in range(SUBMIT_ATTEMPTS):
+    submit_rate_limiter.acquire()
+    try:
+      job_arn = create(spec, job_name, inputs)
+      return {'JobName': job_name, 'JobType': job_type, 'JobArn': job_arn, 'Status': 'InProgress', 'Started': True}
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ResourceInUse':
+        # Another dispatch of the same fingerprint got there first, or the index lost its entry.
+        existing = describe_job(job_type, job_name)
+        if existing['Status'] not in REUSABLE_JOB_STATES:
+          return {'JobName': job_name, 'Error': '%s already exists and is %s' % (job_name, existing['Status'])}
+        log.info("%s already exists, reusing it", job_name)
+        existing['Reused'] = True
+        return existing
+      if e.response['Error']['Code'] not in RETRYABLE_SUBMIT_ERRORS or attempt == SUBMIT_ATTEMPTS - 1:
+        log.critical(e)
+        return {'JobName': job_name, 'Error': str(e)}
+      delay = random.uniform(0, min(SUBMIT_BACKOFF_CAP_SECONDS, SUBMIT_BACKOFF_SECONDS * 2 ** attempt))
+      log.warning("%s throttled (%s), retrying in %.1fs", job_name, e.response['Error']['Code'], delay)
+      time.sleep(delay)
+    except Exception as e:
+      log.critical(e)
+      return {'JobName': job_name, 'Error': str(e)}
+
+
+def create_training_job(spec, job_name, inputs):
+  response = client('sagemaker').create_training_job(
+    TrainingJobName=job_name,
+    HyperParameters=spec['HyperParameters'],
+    Tags=job_tags(spec, inputs),
+    **training_job_definition(spec, inputs)
+  )
+  return response['TrainingJobArn']
+
+
+def create_tuning_job(spec, job_name, inputs):
+  tuning = spec['HyperParameterTuning']
+  tuned = set(parameter['Name'] for ranges in tuning['ParameterRanges'].values() for parameter in ranges)
+  definition = training_job_definition(spec, inputs)
+  if 'MetricDefinitions' in tuning:
+    definition['AlgorithmSpecification']['MetricDefinitions'] = tuning['MetricDefinitions']
+  definition['StaticHyperParameters'] = dict((name, value) for name, value in spec['HyperParameters'].items()
+                                             if name not in tuned)
+  request = {
+    'HyperParameterTuningJobName': job_name,
+    'HyperParameterTuningJobConfig': {
+      'Strategy': tuning.get('Strategy', 'Bayesian'),
+      'HyperParameterTuningJobObjective': tuning['HyperParameterTuningJobObjective'],
+      'ResourceLimits': tuning['ResourceLimits'],
+      'ParameterRanges': tuning['ParameterRanges'],
+      'TrainingJobEarlyStoppingType': tuning.get('TrainingJobEarlyStoppingType', 'Auto')
+    },
+    'TrainingJobDefinition': definition,
+    'Tags': job_tags(spec, inputs)
+  }
+  parent = find_warm_start_parent(spec, inputs.commit_id)
+  if parent:
+    log.info("warm starting %s from %s", job_name, parent)
+    request['WarmStartConfig'] = {'ParentHyperParameterTuningJobs': [{'HyperParameterTuningJobName': parent}],
+                                  'WarmStartType': WARM_START_TYPE}
+  return client('sagemaker').create_hyper_parameter_tuning_job(**request)['HyperParameterTuningJobArn']
+
+
+def find_warm_start_parent(spec, commit_id):
+  # Walk first parents back from this commit and take the best finished tuning job of the same spec on the nearest
+  # commit that has one. Commits that never ran a sweep (docs, notebooks) are skipped over.
+  objective = spec['HyperParameterTuning']['HyperParameterTuningJobObjective']
+  for _ in range(WARM_START_LOOKBACK):
+    commit = client('codecommit').get_commit(repositoryName=os.environ['CODE_COMMIT_REPO'], commitId=commit_id)
+    parents = commit['commit'].get('parents')
+    if not parents:
+      return None
+    commit_id = parents[0]
+    results = client('sagemaker').search(
+      Resource='HyperParameterTuningJob',
+      SearchExpression={'Filters': [{'Name': 'Tags.commitID', 'Operator': 'Equals', 'Value': commit_id},
+                                    {'Name': 'Tags.manifest_job', 'Operator': 'Equals',
+                                     'Value': spec['TrainingJobName']}]})['Results']
+    candidates = [result['HyperParameterTuningJob'] for result in results
+                  if result['HyperParameterTuningJob']['HyperParameterTuningJobStatus'] in ('Completed', 'Stopped')
+                  and 'BestTrainingJob' in result['HyperParameterTuningJob']]
+    if candidates:
+      pick = max if objective['Type'] == 'Maximize' else min
+      best = pick(candidates, key=lambda job: objective_value(job['BestTrainingJob']))
+      return best['HyperParameterTuningJobName']
+  return None
+
+
+def objective_value(training_job):
+  return training_job['FinalHyperParameterTuningJobObjectiveMetric']['Value']
+
+
+def training_job_definition(spec, inputs):
+  # The commit tag is only used to find the image. Jobs name it by digest, so they run exactly what was resolved even
+  # if the tag is moved later, and commits whose build reused an image (see image_hash.py) run the same image.
+  definition = {
+    'AlgorithmSpecification': {
+      'TrainingInputMode': spec.get('TrainingInputMode', 'File'),
+      'TrainingImage': os.environ['TRAINING_IMAGE'] + "@" + inputs.image_digest
+    },
+    'RoleArn': os.environ['SAGEMAKER_ROLE_ARN'],
+    'InputDataConfig': job_channels(spec),
+    'OutputDataConfig': {
+      "KmsKeyId": os.environ['BUCKET_KEY_ARN'].split('/')[-1],
+      "S3OutputPath": os.environ['OUTPUT_BUCKET']
+    },
+    'ResourceConfig': spec['ResourceConfig'],
+    'StoppingCondition': stopping_condition(spec)
+  }
+  if spec.get('EnableManagedSpotTraining'):
+    definition['EnableManagedSpotTraining'] = True
+  if spec.get('EnableManagedSpotTraining') or spec.get('Checkpoints'):
+    definition['CheckpointConfig'] = {'S3Uri': '%s%s/%s/' % (os.environ['CHECKPOINTS'], spec['TrainingJobName'],
+                                                             job_fingerprint(spec, inputs)[:FINGERPRINT_NAME_LENGTH])}
+    if 'CheckpointLocalPath' in spec:
+      definition['CheckpointConfig']['LocalPath'] = spec['CheckpointLocalPath']
+  return definition
+
+
+def stopping_condition(spec):
+  condition = dict(spec['StoppingCondition'])
+  if not spec.get('EnableManagedSpotTraining'):
+    return condition
+  condition.setdefault('MaxWaitTimeInSeconds', spec.get('MaxWaitTimeInSeconds',
+                                                        condition['MaxRuntimeInSeconds'] * SPOT_MAX_WAIT_FACTOR))
+  if condition['MaxWaitTimeInSeconds'] < condition['MaxRuntimeInSeconds']:
+    raise ValueError('%s waits %ds for spot capacity, which is less than its MaxRuntimeInSeconds of %ds' % (
+      spec['TrainingJobName'], condition['MaxWaitTimeInSeconds'], condition['MaxRuntimeInSeconds']))
+  return condition
+
+
+def job_channels(spec):
+  return [input_channel(channel) for channel in spec.get('Channels', [DEFAULT_CHANNEL])]
+
+
+def input_channel(channel):
+  # Prefix is relative to the input bucket; S3Uri is taken as is. Everything else has the same name and default it has
+  # in CreateTrainingJob, plus an optional per channel InputMode (Pipe or FastFile) over the job's TrainingInputMode.
+  config = {
+    "CompressionType": channel.get('CompressionType', 'None'),
+    "ChannelName": channel['ChannelName'],
+    "DataSource": {
+      "S3DataSource": {
+        "S3DataType": channel.get('S3DataType', 'S3Prefix'),
+        "S3DataDistributionType": channel.get('S3DataDistributionType', 'FullyReplicated'),
+        "S3Uri": channel.get('S3Uri', os.environ['INPUT_BUCKET'] + channel.get('Prefix', ''))
+      }
+    },
+    "RecordWrapperType": channel.get('RecordWrapperType', 'None')
+  }
+  for key in ('InputMode', 'ContentType', 'ShuffleConfig'):
+    if key in channel:
+      config[key] = channel[key]
+  return config
+
+
+def job_tags(spec, inputs):
+  return [{'Key': 'commitID', 'Value': inputs.commit_id},
+          {'Key': 'manifest_job', 'Value': spec['TrainingJobName']},
+          {'Key': 'fingerprint', 'Value': job_fingerprint(spec, inputs)},
+          {'Key': 'data_snapshot', 'Value': inputs.data_snapshots[spec['TrainingJobName']]}]
 
 
 def get_manifest_dictionary(artifacts):
-  manifest_file = ''
+  manifest = None
   for artifact in artifacts:
     if os.environ['APP_BUNDLE'] in artifact['name']:
       manifiest_bucket = artifact['location']['s3Location']['bucketName']
       manifiest_key = artifact['location']['s3Location']['objectKey']
-      manifest_file = get_manifest_from_s3(manifiest_bucket, manifiest_key)
-  return json.loads(manifest_file)
+      manifest = manifest_cache.get(manifiest_bucket, manifiest_key)
+      if manifest is None:
+        manifest_file, etag = get_manifest_from_s3(manifiest_bucket, manifiest_key)
+        manifest = json.loads(manifest_file)
+        manifest_cache.put(manifiest_bucket, manifiest_key, etag, manifest_file)
+  log.info("manifest cache: %(hits)d hits, %(misses)d misses, %(spill_hits)d spill hits, %(evictions)d evictions",
+           manifest_cache.stats())
+  if manifest is None:
+    raise ValueError('no %s artifact in %s' % (os.environ['APP_BUNDLE'], [a['name'] for a in artifacts]))
+  return manifest
 
 
 def get_manifest_from_s3(bucket, key):
-  tmp_file = tempfile.NamedTemporaryFile()
-  with tempfile.NamedTemporaryFile() as tmp_file:
-    s3.download_file(bucket, key, tmp_file.name)
-    with zipfile.ZipFile(tmp_file.name, 'r') as zip:
-      return zip.read('manifest.json')
+  # Only the zip index and the manifest.json member are fetched, so this costs the same for a 1MB or a 1GB artifact.
+  with io.BufferedReader(S3RangeReader(client('s3'), bucket, key), buffer_size=ZIP_READ_BUFFER_BYTES) as artifact:
+    with zipfile.ZipFile(artifact, 'r') as zip:
+      return zip.read('manifest.json'), artifact.raw.etag
+
+
+class ManifestCache(object):
+  """Bounded LRU of manifests keyed by artifact bucket, key and ETag.
+
+  Pipeline artifacts are never rewritten in place, so once an artifact key has been seen its ETag is remembered and
+  later lookups are answered without touching s3. Entries pushed out of memory are spilled to spill_dir (normally
+  somewhere under /tmp) when one is configured, which outlives the in-memory LRU but not the container. dispatch_worker
+  processes jobs on several threads at once, so every access goes through one lock.
+  """
+
+  def __init__(self, max_entries, max_bytes, spill_dir=''):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.spill_dir = spill_dir
+    self._entries = collections.OrderedDict()
+    self._etags = collections.OrderedDict()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.spill_hits = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+
+  def get(self, bucket, key):
+    with self._lock:
+      return self._get(bucket, key)
+
+  def put(self, bucket, key, etag, manifest_file):
+    with self._lock:
+      self._put(bucket, key, etag, manifest_file)
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'spill_hits': self.spill_hits, 'evictions': self.evictions,
+              'entries': len(self._entries), 'bytes': self._bytes}
+
+  def _get(self, bucket, key):
+    etag = self._etags.get((bucket, key))
+    cache_key = (bucket, key, etag)
+    if cache_key in self._entries:
+      self._entries[cache_key] = self._entries.pop(cache_key)
+      self.hits += 1
+      return copy.deepcopy(self._entries[cache_key][0])
+    if etag is not None and self.spill_dir:
+      try:
+        with open(self._spill_path(cache_key), 'rb') as spilled:
+          manifest_file = spilled.read()
+      except (IOError, OSError):
+        pass
+      else:
+        self.spill_hits += 1
+        self._put(bucket, key, etag, manifest_file)
+        return json.loads(manifest_file)
+    self.misses += 1
+    return None
+
+  def _put(self, bucket, key, etag, manifest_file):
+    cache_key = (bucket, key, etag)
+    if cache_key in self._entries:
+      self._bytes -= len(self._entries.pop(cache_key)[1])
+    self._etags.pop((bucket, key), None)
+    self._etags[(bucket, key)] = etag
+    while len(self._etags) > 2 * self.max_entries:
+      self._etags.popitem(last=False)
+    self._entries[cache_key] = (json.loads(manifest_file), manifest_file)
+    self._bytes += len(manifest_file)
+    while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+      self._evict()
+
+  def _evict(self):
+    cache_key, (manifest, manifest_file) = self._entries.popitem(last=False)
+    self._bytes -= len(manifest_file)
+    self.evictions += 1
+    if not self.spill_dir:
+      self._etags.pop(cache_key[:2], None)
+      return
+    try:
+      if not os.path.isdir(self.spill_dir):
+        os.makedirs(self.spill_dir)
+      with open(self._spill_path(cache_key), 'wb') as spilled:
+        spilled.write(manifest_file)
+      self._prune_spill_dir()
+    except (IOError, OSError) as e:
+      log.warning("could not spill manifest for s3://%s/%s: %s", cache_key[0], cache_key[1], e)
+
+  def _prune_spill_dir(self):
+    # The spill directory is held to the same entry bound as memory; the oldest files go first.
+    paths = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir)]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:max(0, len(paths) - self.max_entries)]:
+      os.remove(path)
+
+  def _spill_path(self, cache_key):
+    return os.path.join(self.spill_dir, hashlib.sha1('/'.join(cache_key).encode('utf-8')).hexdigest() + '.json')
+
+
+manifest_cache = ManifestCache(MANIFEST_CACHE_ENTRIES, MANIFEST_CACHE_BYTES, MANIFEST_CACHE_DIR)
+
+
+class S3RangeReader(io.RawIOBase):
+  """Read-only, seekable file object over an s3 object that fetches the bytes it is asked for with ranged GETs.
+
+  The tail of the object is fetched up front, which gives us the object size and the zip index in a single request.
+  Later reads are pinned to the ETag of that first response so a concurrently replaced object fails loudly instead of
+  being spliced together from two versions.
+  """
+
+  def __init__(self, s3_client, bucket, key, tail_bytes=ZIP_TAIL_BYTES):
+    super(S3RangeReader, self).__init__()
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.key = key
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range='bytes=-%d' % tail_bytes)
+    self.etag = response['ETag']
+    self._tail = response['Body'].read()
+    if 'ContentRange' in response:
+      self.size = int(response['ContentRange'].split('/')[-1])
+    else:
+      self.size = len(self._tail)
+    self._tail_offset = self.size - len(self._tail)
+    self._position = 0
+    log.debug("opened s3://%s/%s (%d bytes, etag %s)", bucket, key, self.size, self.etag)
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self._position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      position = offset
+    elif whence == io.SEEK_CUR:
+      position = self._position + offset
+    elif whence == io.SEEK_END:
+      position = self.size + offset
+    else:
+      raise ValueError('invalid whence (%r)' % whence)
+    if position < 0:
+      raise ValueError('negative seek position %d' % position)
+    self._position = position
+    return position
+
+  def readinto(self, buffer):
+    end = min(self._position + len(buffer), self.size)
+    if end <= self._position:
+      return 0
+    if self._position >= self._tail_offset:
+      data = self._tail[self._position - self._tail_offset:end - self._tail_offset]
+    else:
+      log.debug("fetching bytes %d-%d of s3://%s/%s", self._position, end - 1, self.bucket, self.key)
+      response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, IfMatch=self.etag,
+                                           Range='bytes=%d-%d' % (self._position, end - 1))
+      data = response['Body'].read()
+    buffer[:len(data)] = data
+    self._position += len(data)
+    return len(data)
+
+
+class TokenBucket(object):
+  """Thread safe token bucket; acquire() blocks until a token is available."""
+
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self._tokens = float(capacity)
+    self._updated = time.time()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self._lock:
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self.rate
+      time.sleep(wait)
+
+
+submit_rate_limiter = TokenBucket(SUBMIT_RATE, SUBMIT_BURST)
 
 
-def put_job_success(job, message):
+def put_job_success(job, message, codepipeline, continuation_token=None):
   log.info('Putting job success')
   log.debug(message)
   try:
-    code_pipeline.put_job_success_result(jobId=job)
+    # The execution summary is what shows up on the action in the console and is capped at 2048 characters.
+    request = {'jobId': job, 'executionDetails': {'summary': message[:2048]}}
+    if continuation_token:
+      request['continuationToken'] = continuation_token
+    codepipeline.put_job_success_result(**request)
   except Exception as e:
     log.critical(e)
 
 
-def put_job_failure(job, message):
+def put_job_failure(job, message, codepipeline):
   log.info('Putting job failure')
   log.debug(message)
   try:
-    code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
+    codepipeline.put_job_failure_result(jobId=job, failureDetails={'message': message[:5000], 'type': 'JobFailed'})
   except Exception as e:
     log.critical(e)
\ No newline at end of file
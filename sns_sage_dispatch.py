@@ -1,13 +1,120 @@
-import os
-import boto3
+import concurrent.futures
+import fnmatch
 import json
-import subprocess
+import logging
+import os
+
+from botocore.exceptions import ClientError
+
+import sageDispatch
+from sageDispatch import client
+
+log = logging.getLogger()
+
+# Starts the pipeline for a push only when the push changed something the model depends on. The paths that count are
+# the TriggerPaths globs in the manifest of the pushed commit, plus the files that make up the build itself, so a push
+# that only touches docs or notebooks doesn't queue hours of training. Every record of the event is looked at, and
+# each push is diffed against the commit it replaced with get_differences, the pushes of a batch side by side. Works
+# with EventBridge repository state change events and with CodeCommit triggers (directly or through SNS, like
+# sns_event.json). Triggers don't say which commit a push replaced, so those pushes are diffed against the commit the
+# pipeline last built or is building instead, which covers every commit of the push, and every push since then.
+BRANCH = os.environ.get('BRANCH', 'master')
+MANIFEST_PATH = 'manifest.json'
+ALWAYS_TRIGGER_PATHS = ['Dockerfile', 'buildspec.yml', MANIFEST_PATH]
+DEFAULT_TRIGGER_PATHS = ['train', 'serve']
+DIFF_WORKERS = 4
+DELETED_COMMIT = '0' * 40
+BUILT_EXECUTION_STATES = ('InProgress', 'Succeeded')
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=DIFF_WORKERS)
+
 
 def handler(event, context):
-  sns_message = event['Records'][0]['Sns']['Message']
-  message = json.loads(sns_message)
-  region = message['Records'][0]['awsRegion']
-  arn = message['Records'][0]['eventSourceARN']
-  repo = arn.split(":")[-1]
-  clone_url = 'https://git-codecommit.%s.amazonaws.com/v1/repos/%s' % (region, repo)
-  print clone_url
+  sageDispatch.configure_logging()
+  log.debug(event)
+  pushes = [push for push in event_pushes(event) if push['ref'] == 'refs/heads/' + BRANCH]
+  if any(not push['old_commit'] for push in pushes):
+    built = last_built_commit()
+    pushes = [dict(push, old_commit=push['old_commit'] or built) for push in pushes]
+  matches = [match for match in executor.map(push_match, pushes) if match]
+  if not matches:
+    log.info("%d pushes to %s changed nothing the model depends on", len(pushes), BRANCH)
+    return {'Started': False, 'Pushes': len(pushes)}
+  # The pipeline checks out the head of the branch, so one execution covers every push in the batch.
+  execution = client('codepipeline').start_pipeline_execution(name=os.environ['PIPELINE_NAME'])
+  log.info("started %s for %s", execution['pipelineExecutionId'], '; '.join(matches))
+  return {'Started': True, 'Pushes': len(pushes), 'PipelineExecutionId': execution['pipelineExecutionId']}
+
+
+def event_pushes(event):
+  # Returns one {'repository', 'ref', 'commit', 'old_commit'} per reference update in the event.
+  if 'detail' in event:
+    detail = event['detail']
+    return [{'repository': detail['repositoryName'], 'ref': 'refs/heads/' + detail['referenceName'],
+             'commit': detail.get('commitId'), 'old_commit': detail.get('oldCommitId')}]
+  pushes = []
+  for record in event.get('Records', []):
+    records = json.loads(record['Sns']['Message'])['Records'] if 'Sns' in record else [record]
+    for trigger in records:
+      repository = trigger['eventSourceARN'].split(':')[-1]
+      for reference in trigger['codecommit']['references']:
+        if reference.get('deleted'):
+          continue
+        pushes.append({'repository': repository, 'ref': reference['ref'], 'commit': reference['commit'],
+                       'old_commit': reference.get('oldCommit')})
+  return pushes
+
+
+def push_match(push):
+  # Returns a description of the first relevant change in the push, or None.
+  if not push['commit'] or push['commit'] == DELETED_COMMIT:
+    return None
+  patterns = trigger_paths(push['repository'], push['commit'])
+  for path in changed_paths(push['repository'], push['old_commit'], push['commit']):
+    if path_matches(path, patterns):
+      return '%s changed in %s' % (path, push['commit'])
+  return None
+
+
+def trigger_paths(repository, commit):
+  try:
+    manifest = client('codecommit').get_file(repositoryName=repository, commitSpecifier=commit, filePath=MANIFEST_PATH)
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'FileDoesNotExistException':
+      raise
+    return ALWAYS_TRIGGER_PATHS + DEFAULT_TRIGGER_PATHS
+  manifest = json.loads(manifest['fileContent'])
+  return ALWAYS_TRIGGER_PATHS + manifest.get('TriggerPaths', manifest.get('BuildSources', DEFAULT_TRIGGER_PATHS))
+
+
+def last_built_commit():
+  # The source revision of the newest execution that is running or succeeded. None when there is none, and
+  # get_differences then lists every file in the pushed commit, so the pipeline starts.
+  paginator = client('codepipeline').get_paginator('list_pipeline_executions')
+  for page in paginator.paginate(pipelineName=os.environ['PIPELINE_NAME']):
+    for execution in page['pipelineExecutionSummaries']:
+      if execution['status'] in BUILT_EXECUTION_STATES and execution.get('sourceRevisions'):
+        return execution['sourceRevisions'][0]['revisionId']
+  return None
+
+
+def changed_paths(repository, before, after):
+  # Pages are fetched as they're needed, so a push that matches on the first page costs a single call.
+  kwargs = {'repositoryName': repository, 'afterCommitSpecifier': after}
+  if before and before != DELETED_COMMIT:
+    kwargs['beforeCommitSpecifier'] = before
+  paginator = client('codecommit').get_paginator('get_differences')
+  for page in paginator.paginate(**kwargs):
+    for difference in page['differences']:
+      for side in ('beforeBlob', 'afterBlob'):
+        if side in difference:
+          yield difference[side]['path']
+
+
+def path_matches(path, patterns):
+  # A pattern is a glob over the repo relative path; a plain directory name covers everything under it.
+  for pattern in patterns:
+    pattern = pattern.rstrip('/')
+    if fnmatch.fnmatchcase(path, pattern) or path.startswith(pattern + '/'):
+      return True
+  return False
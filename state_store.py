@@ -0,0 +1,117 @@
+import errno
+import os
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Small key/value stores for the bits of state the pipeline Lambdas keep between invocations. A location of the form
+# s3://bucket/prefix/ is backed by s3; anything else is treated as a local directory, which is what you want when
+# running the handlers from a laptop or a test. create() only writes a record that isn't there yet and says whether it
+# did, which is enough to build a lock on.
+
+
+def open_store(location, s3_client=None):
+  if location.startswith('s3://'):
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    return S3Store(s3_client or boto3.client('s3'), bucket, prefix)
+  return LocalStore(location)
+
+
+class S3Store(object):
+
+  def __init__(self, s3_client, bucket, prefix=''):
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.prefix = prefix
+
+  def get(self, name):
+    try:
+      return self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + name)['Body'].read()
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return None
+      raise
+
+  def put(self, name, data):
+    self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+  def create(self, name, data):
+    try:
+      self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data, IfNoneMatch='*')
+      return True
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+        return False
+      raise
+
+  def delete(self, name):
+    self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+  def list(self, prefix=''):
+    names = []
+    paginator = self.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+      names.extend(obj['Key'][len(self.prefix):] for obj in page.get('Contents', []))
+    return sorted(names)
+
+  def __repr__(self):
+    return 's3://%s/%s' % (self.bucket, self.prefix)
+
+
+class LocalStore(object):
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def get(self, name):
+    try:
+      with open(os.path.join(self.directory, name), 'rb') as stored:
+        return stored.read()
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+
+  def put(self, name, data):
+    path = os.path.join(self.directory, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    # Write then rename so a concurrent reader never sees half a record.
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as stored:
+      stored.write(data)
+    os.rename(tmp_path, path)
+
+  def create(self, name, data):
+    path = os.path.join(self.directory, name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except OSError as e:
+      if e.errno == errno.EEXIST:
+        return False
+      raise
+    with os.fdopen(fd, 'wb') as stored:
+      stored.write(data)
+    return True
+
+  def delete(self, name):
+    try:
+      os.remove(os.path.join(self.directory, name))
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def list(self, prefix=''):
+    names = []
+    for root, _, files in os.walk(self.directory):
+      for file_name in files:
+        name = os.path.relpath(os.path.join(root, file_name), self.directory).replace(os.sep, '/')
+        if name.startswith(prefix) and not name.endswith('.tmp'):
+          names.append(name)
+    return sorted(names)
+
+  def __repr__(self):
+    return self.directory